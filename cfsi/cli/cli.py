@@ -1,29 +1,41 @@
 import argparse
+import sys
+import time
 from collections import namedtuple
-from datetime import datetime
-from typing import List, Optional
+from dataclasses import dataclass
+from typing import FrozenSet, List, Optional, Tuple
 
-Action = namedtuple("Action", "name description excludes")
 ActionMap = namedtuple("ActionMap", "action method")
 
+
+@dataclass(frozen=True)
+class Action:
+    """ CLI action, excludes are names of actions that can't be run together with this one """
+    __slots__ = ("name", "description", "excludes")
+    name: str
+    description: str
+    excludes: FrozenSet[str]
+
+
 CLI_ACTIONS = (
-    Action("build", "Rebuilds CFSI Docker images", [False]),
-    Action("start", "Starts ODC database container", [False]),
-    Action("init", "Initialize ODC database schema", [False]),
-    Action("stop", "Stops ODC database container", [False]),
-    Action("clean", "Stops ODC database container and deletes data", [False]),
-    Action("console", "Opens bash shell inside CFSI container", [False]),
-    Action("index", "Index S2 images to ODC from AWS S3", [False]),
-    Action("mask", "Generate cloud and shadow masks", [False]),
-    Action("mosaic", "Create cloudless mosaics", [False]),
-    Action("deploy", "Deploy CFSI with TerraForm", [False]),
-    Action("destroy", "Destroy CFSI resources with TerraForm", [False]),
-    Action("log", "Display logs from Docker-Compose", [False])
+    Action("build", "Rebuilds CFSI Docker images", frozenset()),
+    Action("start", "Starts ODC database container", frozenset()),
+    Action("init", "Initialize ODC database schema", frozenset()),
+    Action("stop", "Stops ODC database container", frozenset()),
+    Action("clean", "Stops ODC database container and deletes data", frozenset()),
+    Action("console", "Opens bash shell inside CFSI container", frozenset()),
+    Action("index", "Index S2 images to ODC from AWS S3", frozenset()),
+    Action("mask", "Generate cloud and shadow masks", frozenset()),
+    Action("mosaic", "Create cloudless mosaics", frozenset()),
+    Action("deploy", "Deploy CFSI with TerraForm", frozenset()),
+    Action("destroy", "Destroy CFSI resources with TerraForm", frozenset()),
+    Action("log", "Display logs from Docker-Compose", frozenset())
 )
+CLI_ACTION_MAP = {action.name: action for action in CLI_ACTIONS}
 
 
 def generate_container_name(name):
-    return f"{name}_{datetime.now().strftime('%y-%m-%d_%M-%S')}"
+    return f"{name}_{time.strftime('%y-%m-%d_%M-%S')}"
 
 
 class CFSICLIParser:
@@ -33,15 +45,30 @@ class CFSICLIParser:
     def parse(self) -> (List[Action], argparse.Namespace):
         """ Parses and validates user input arguments
         :return: List of methods to run and optional arguments """
+        fast_path_result = self.__parse_action_names_only(sys.argv[1:])
+        if fast_path_result:
+            return fast_path_result
+
         parser = self.__create_arg_parser()
         args = parser.parse_args()
 
-        self.__validate_args(args)
         actions = self.actions_from_names(args.actions)
+        self.__validate_args(args, actions)
 
         vars(args).pop("actions")
         return actions, args
 
+    def __parse_action_names_only(self, argv: List[str]) -> Optional[Tuple[List[Action], argparse.Namespace]]:
+        """ Parses arguments without building the argparse parser when they are only valid action names.
+        Returns None for anything else, e.g. options or invalid names, which are left to argparse """
+        if not argv or any(arg.startswith("-") for arg in argv):
+            return None
+        actions = self.actions_from_names(argv)
+        if None in actions:
+            return None
+        self.__check_action_combination_valid(actions)
+        return actions, argparse.Namespace(detach=False)
+
     @staticmethod
     def actions_from_names(action_names: List[str]) -> List[Action]:
         """ Returns a list of actions matching a list of strings """
@@ -50,10 +77,7 @@ class CFSICLIParser:
     @staticmethod
     def action_from_name(action_name: str) -> Optional[Action]:
         """ Returns action with matching name """
-        for action in CLI_ACTIONS:
-            if action_name == action.name:
-                return action
-        return None
+        return CLI_ACTION_MAP.get(action_name)
 
     @staticmethod
     def __create_arg_parser():
@@ -71,13 +95,11 @@ class CFSICLIParser:
 
         return parser
 
-    def __validate_args(self, args: argparse.Namespace):
+    def __validate_args(self, args: argparse.Namespace, actions: List[Optional[Action]]):
         if args.detach and len(args.actions) > 1:
             raise ValueError("Optional argument detach only works when"
                              "a single action argument is given!")
 
-        actions = CFSICLIParser.actions_from_names(args.actions)
-
         if None in actions:
             invalid_arguments = [args.actions[i]
                                  for i, action in enumerate(actions) if not action]
@@ -87,13 +109,9 @@ class CFSICLIParser:
 
     @staticmethod
     def __check_action_combination_valid(actions: List[Action]):
-        conflicting_actions = []
-        action_names = [action.name for action in actions]
-
-        for action in actions:
-            for excluded_action in action.excludes:
-                if excluded_action in action_names:
-                    conflicting_actions.append((action.name, excluded_action))
+        action_names = frozenset(action.name for action in actions)
+        conflicting_actions = [(action.name, excluded_action) for action in actions
+                               for excluded_action in sorted(action_names & action.excludes)]
 
         if conflicting_actions:
             conflicting_pairs = ', '.join([f"{action[0]}-{action[1]}"
@@ -1,3 +1,5 @@
+from functools import lru_cache
+import mmap
 import os
 from typing import Dict
 from pathlib import Path
@@ -6,18 +8,18 @@ from types import SimpleNamespace
 import yaml
 from yaml.parser import ParserError
 
+# libyaml based loader when PyYAML is built with it, same results as yaml.safe_load
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
+
+@lru_cache(maxsize=1)
 def load_config() -> SimpleNamespace:
-    """ Loads and returns CFSI config """
+    """ Loads and returns CFSI config. The config is loaded once per process, later calls return the same object """
 
     def _dict_to_namespace(d: Dict) -> SimpleNamespace:
-        """ Recursively convert a dict into a SimpleNamespace """
-        if not isinstance(d, dict):
-            raise ValueError("Can only convert dicts to SimpleNamespace")
-        for k, v in d.items():
-            if isinstance(v, dict):
-                d[k] = _dict_to_namespace(v)
-        return SimpleNamespace(**d)
+        """ Recursively convert a dict into a SimpleNamespace, without modifying the dict """
+        return SimpleNamespace(**{k: _dict_to_namespace(v) if isinstance(v, dict) else v
+                                  for k, v in d.items()})
 
     try:
         config_path = Path(os.environ["CFSI_CONFIG_CONTAINER"])
@@ -27,24 +29,31 @@ def load_config() -> SimpleNamespace:
             raise ValueError("Invalid CFSI_CONFIG_CONTAINER value")  # TODO: custom exception
     except KeyError:
         print("Environment variable CFSI_CONFIG_CONTAINER not set, "
-              f"trying to load configuration from CFSI_CONFIG_HOST")
+              "trying to load configuration from CFSI_CONFIG_HOST")
         config_path = Path(os.environ["CFSI_CONFIG_HOST"])
     config_data = _load_config_file(config_path)
+    if not isinstance(config_data, dict):
+        raise ValueError("Can only convert dicts to SimpleNamespace")
     return _dict_to_namespace(config_data)
 
 
 def _load_config_file(config_path: Path):
     """ Loads and parses a configuration file from given path """
     try:
-        with open(config_path) as config_file:
-            try:
-                config_data = yaml.safe_load(config_file)
-            except ParserError:  # TODO: handle errors in cfg
-                raise
-            return config_data
-
+        stat = config_path.stat()
     except FileNotFoundError as err:
-        print("Error loading configuration: " 
-              f"CFSI configuration file not found at {config_path}, " 
+        print("Error loading configuration: "
+              f"CFSI configuration file not found at {config_path}, "
               f"ensure configuration file exists: {err}")
         exit(1)
+
+    config_data = None
+    if stat.st_size:  # empty files can't be memory mapped
+        # the file is memory mapped and parsed as bytes, libyaml decodes UTF-8 itself
+        with open(config_path, "rb") as config_file, \
+                mmap.mmap(config_file.fileno(), 0, access=mmap.ACCESS_READ) as config_map:
+            try:
+                config_data = yaml.load(config_map, Loader=YAML_LOADER)
+            except ParserError:  # TODO: handle errors in cfg
+                raise
+    return config_data
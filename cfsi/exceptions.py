@@ -7,3 +7,12 @@ class CFSIException(Exception):
 class ProductNotFoundException(CFSIException):
     """ Raised when product not found in index """
     pass
+
+
+class MaskIndexingException(CFSIException):
+    """ Raised when indexing masks fails for some datasets of a batch """
+
+    def __init__(self, message: str, indexed: list):
+        """ :param indexed: ODCDatasets of the batch that were indexed """
+        super().__init__(message)
+        self.indexed = indexed
@@ -1,24 +1,35 @@
 import os
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, List, Optional, Tuple, Union
 from types import SimpleNamespace
 from urllib.parse import urlparse
 from xml.etree import ElementTree
 
 from boto3 import Session
+from botocore.config import Config
 from datacube import Datacube
 from datacube.index.hl import Doc2Dataset
 from datacube.model import Dataset as ODCDataset
 from datacube.utils import changes
 from datacube.utils.changes import DocumentMismatchError
 
-from cfsi.exceptions import ProductNotFoundException
+from cfsi.exceptions import MaskIndexingException, ProductNotFoundException
 from cfsi.utils.load_datasets import odcdataset_from_uri
 from cfsi.utils.logger import create_logger
-from cfsi.utils.utils import swap_s2_bucket_names
+from cfsi.utils.utils import available_cpus, mark_mask_directory_done, swap_s2_bucket_names
 
 LOGGER = create_logger("ODCIndexer")
 
+# Sun and viewing angle grids of each band and detector make up most of a S2 metadata.xml,
+# they are not read by the indexers
+UNUSED_S2_METADATA_ELEMENTS = frozenset(("Sun_Angles_Grid", "Viewing_Incidence_Angles_Grids"))
+# Shared by all S3 listing and fetching threads, the default pool of 10 connections would make them
+# wait for free connections or open new ones for every request
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=max(64, 8 * available_cpus()),  # default list and fetch workers use 4 per CPU each
+    retries={"mode": "adaptive", "max_attempts": 10},  # client side rate limiting on throttling errors
+)
+
 
 class ODCIndexer:
     """ Index data to CFSI ODC - base class """
@@ -30,6 +41,9 @@ class ODCIndexer:
             aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
             aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY'],
             region_name='eu-central-1')
+        # a single client is reused for all S3 requests, so its pooled HTTP connections are kept alive
+        self.s3_client = self.session.client("s3", config=S3_CLIENT_CONFIG)
+        self.__resolver: Optional[Doc2Dataset] = None
 
     def index_masks(self, l1c_dataset: ODCDataset, mask_output: Dict[str, Path]) -> ODCDataset:
         """ Indexes output cloud masks to ODC.
@@ -42,8 +56,25 @@ class ODCIndexer:
 
         if exception:
             raise Exception(exception)  # TODO: custom exception
+        mark_mask_directory_done(mask_output.values())
         return dataset
 
+    def index_mask_batch(self, masks: List[Tuple[ODCDataset, Dict[str, Path]]]) -> List[ODCDataset]:
+        """ Indexes output cloud masks of multiple L1C datasets with a single indexer.
+        Every dataset is indexed even if some of them fail, MaskIndexingException is raised after the batch.
+        :param masks: list of (L1C ODCDataset, dict of {mask name: mask file path}) """
+        LOGGER.info(f"Indexing masks for {len(masks)} datasets")
+        indexed, failed = [], 0
+        for l1c_dataset, mask_output in masks:
+            try:
+                indexed.append(self.index_masks(l1c_dataset, mask_output))
+            except Exception as err:
+                LOGGER.error(f"Error indexing masks for {l1c_dataset.uris[0]}: {err}")
+                failed += 1
+        if failed:
+            raise MaskIndexingException(f"Indexing masks failed for {failed}/{len(masks)} datasets", indexed)
+        return indexed
+
     def generate_eo3_dataset_doc(self, l1c_dataset: ODCDataset, masks: Dict[str, Path]) -> Dict:
         """ Overridden in subclasses """
         pass
@@ -86,13 +117,21 @@ class ODCIndexer:
         grids = self.read_s2_grid_metadata(l1c_metadata_doc)
         return properties, grids
 
+    @property
+    def resolver(self) -> Doc2Dataset:
+        """ Doc2Dataset resolver with default options. Creating a resolver loads the product matching rules
+        from the index, so it's created once and reused for all added datasets """
+        if self.__resolver is None:
+            self.__resolver = Doc2Dataset(self.dc.index)
+        return self.__resolver
+
     def add_dataset(self, eo3_doc: Dict, uri: str = "", **kwargs) -> (ODCDataset, Union[Exception, None]):
         """ Adds dataset to dcIndex """
         if not uri:
             uri = eo3_doc["uri"]
         LOGGER.debug(f"Indexing {uri}")
         index = self.dc.index
-        resolver = Doc2Dataset(index, **kwargs)
+        resolver = Doc2Dataset(index, **kwargs) if kwargs else self.resolver
         dataset, err = resolver(eo3_doc, uri)
         if err is not None:
             LOGGER.error(f"Error indexing {uri}: {err}")
@@ -103,7 +142,6 @@ class ODCIndexer:
             index.datasets.update(dataset, {tuple(): changes.allow_any})
         except Exception as err:
             LOGGER.error(f"Unhandled exception {err}")
-            pass
 
         return dataset, err
 
@@ -114,6 +152,10 @@ class ODCIndexer:
             return False
         return True
 
+    def dataset_ids_exist(self, ids: List[str]) -> List[bool]:
+        """ Check which of the dataset ids are already in index, using a single query """
+        return self.dc.index.datasets.bulk_has(ids)
+
     @staticmethod
     def generate_s3_uri(bucket_name: str, key: str) -> str:
         """ Gets a URI based on S3 bucket name and key """
@@ -139,48 +181,60 @@ class ODCIndexer:
 
     def get_object_from_s3(self, bucket_name: str, key: str, **kwargs):
         """ Gets an object from S3 bucket with key """
-        s3 = self.session.resource("s3")
-        return s3.Object(bucket_name, key).get(**kwargs)
+        return self.s3_client.get_object(Bucket=bucket_name, Key=key, **kwargs)
 
     @staticmethod
     def s3obj_to_etree(obj) -> ElementTree:
-        """ Reads an S3 object to a ElementTree. Used for reading metadata.xml """
-        return ElementTree.fromstring(str(obj["Body"].read(), "utf-8"))
+        """ Reads an S3 object to a ElementTree. Used for reading metadata.xml.
+        The body is streamed to the parser in blocks, the whole document is never held as bytes.
+        Angle grid elements are emptied as soon as they are parsed,
+        only one of them is held in memory at a time """
+        parser = ElementTree.iterparse(obj["Body"])
+        for _, element in parser:
+            if element.tag in UNUSED_S2_METADATA_ELEMENTS:
+                element.clear()
+        return parser.root
 
     @staticmethod
     def read_s2_tile_metadata(data: ElementTree) -> SimpleNamespace:
-        """ Reads necessary metadata from an metadata.xml ElementTree """
+        """ Reads necessary metadata from an metadata.xml ElementTree.
+        The top level sections are walked once, the values are then read from the collected elements """
+        elements = {}
+        for section in data:
+            for element in section:
+                elements.setdefault(element.tag, element)
+        mean_sun_angle = elements["Tile_Angles"].find("Mean_Sun_Angle")
         return SimpleNamespace(
-            tile_id=data.find("./*/TILE_ID").text,
-            sensing_time=data.find("./*/SENSING_TIME").text,
-            crs_code=data.find("./*/Tile_Geocoding/HORIZONTAL_CS_CODE").text.upper(),
-            sun_zenith=float(data.find("./*/Tile_Angles/Mean_Sun_Angle/ZENITH_ANGLE").text),
-            sun_azimuth=float(data.find("./*/Tile_Angles/Mean_Sun_Angle/AZIMUTH_ANGLE").text),
-            cloudy_pixel_percentage=float(data.find("./*/Image_Content_QI/CLOUDY_PIXEL_PERCENTAGE").text),
+            tile_id=elements["TILE_ID"].text,
+            sensing_time=elements["SENSING_TIME"].text,
+            crs_code=elements["Tile_Geocoding"].find("HORIZONTAL_CS_CODE").text.upper(),
+            sun_zenith=float(mean_sun_angle.find("ZENITH_ANGLE").text),
+            sun_azimuth=float(mean_sun_angle.find("AZIMUTH_ANGLE").text),
+            cloudy_pixel_percentage=float(elements["Image_Content_QI"].find("CLOUDY_PIXEL_PERCENTAGE").text),
         )
 
     @staticmethod
     def read_s2_grid_metadata(data: ElementTree) -> Dict:
-        """ Reads grid metadata from metadata.xml ElementTree. Returns a dict of 10, 20, 60m grids """
+        """ Reads grid metadata from metadata.xml ElementTree. Returns a dict of 10, 20, 60m grids.
+        The Size and Geoposition elements of all resolutions are read in a single pass over Tile_Geocoding """
         grids = {
             "10": {},
             "20": {},
             "60": {},
         }
-        for resolution in grids:
-            grids[resolution]["nrows"] = int(data.findall(
-                f"./*/Tile_Geocoding/Size[@resolution='{resolution}']/NROWS")[0].text)
-            grids[resolution]["ncols"] = int(data.findall(
-                f"./*/Tile_Geocoding/Size[@resolution='{resolution}']/NCOLS")[0].text)
-            grids[resolution]["ulx"] = float(data.findall(
-                f"./*/Tile_Geocoding/Geoposition[@resolution='{resolution}']/ULX")[0].text)
-            grids[resolution]["uly"] = float(data.findall(
-                f"./*/Tile_Geocoding/Geoposition[@resolution='{resolution}']/ULY")[0].text)
-            grids[resolution]["xdim"] = float(data.findall(
-                f"./*/Tile_Geocoding/Geoposition[@resolution='{resolution}']/XDIM")[0].text)
-            grids[resolution]["ydim"] = float(data.findall(
-                f"./*/Tile_Geocoding/Geoposition[@resolution='{resolution}']/YDIM")[0].text)
-            grids[resolution]["trans"] = [grids[resolution]["xdim"], 0.0, grids[resolution]["ulx"], 0.0,
-                                          grids[resolution]["ydim"], grids[resolution]["uly"],
-                                          0.0, 0.0, 1.0]
+        for element in data.find("./*/Tile_Geocoding"):
+            grid = grids.get(element.get("resolution"))
+            if grid is None:
+                continue
+            for child in element:
+                grid.setdefault(child.tag.lower(), child.text)
+
+        for grid in grids.values():
+            grid["nrows"] = int(grid["nrows"])
+            grid["ncols"] = int(grid["ncols"])
+            for key in ("ulx", "uly", "xdim", "ydim"):
+                grid[key] = float(grid[key])
+            grid["trans"] = [grid["xdim"], 0.0, grid["ulx"], 0.0,
+                             grid["ydim"], grid["uly"],
+                             0.0, 0.0, 1.0]
         return grids
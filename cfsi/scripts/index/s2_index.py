@@ -1,13 +1,17 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from functools import partial
 from queue import Queue
 from pathlib import Path
-from queue import Empty
-from typing import Dict, List
+from queue import Empty, Full
+from threading import Event
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 from xml.etree import ElementTree
 from hashlib import md5
 
 import cfsi
 from cfsi.scripts.index import ODCIndexer
+from cfsi.utils import available_cpus
 from cfsi.utils.logger import create_logger
 
 from cfsi.constants import (GUARDIAN, L2A_BUCKET, S2_MEASUREMENTS, S2_PRODUCT_NAMES)
@@ -15,6 +19,53 @@ from cfsi.constants import (GUARDIAN, L2A_BUCKET, S2_MEASUREMENTS, S2_PRODUCT_NA
 config = cfsi.config()
 LOGGER = create_logger("s2_index")
 
+# Max. nr. of listed keys waiting to be indexed, the listing thread blocks when the queue is full
+S3_INDEXING_QUEUE_SIZE = 1024
+# Max. nr. of queued keys checked against the index with a single query
+INDEX_CHECK_BATCH_SIZE = 64
+# S3 requests are latency bound, default nr. of S3 listing and fetching threads per available CPU
+S3_WORKERS_PER_CPU = 4
+
+
+def _generate_s2_measurements(bucket_name: str) -> Dict:
+    """ Generates a measurement dict for eo3 document, paths are relative to the dataset location """
+    res = {}
+    for measurement in S2_MEASUREMENTS[bucket_name]:
+        band, resolution = measurement.split("_")
+        if bucket_name == L2A_BUCKET:
+            file_name = f"R{resolution}/{band}"
+        else:
+            measurement = file_name = band
+        res[measurement] = {"path": f"{file_name}.jp2"}
+        if resolution == "10m":
+            grid = "default"
+        else:
+            grid = resolution
+        res[measurement]["grid"] = grid
+    return res
+
+
+def _put_unless_stopped(queue: Queue, item: str, stop: Event) -> bool:
+    """ Puts item to a bounded queue, waiting while the queue is full. Returns False without putting
+    the item once stop is set, so producers never block forever after the consumer has stopped """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _s3_workers(configured_workers: int) -> int:
+    """ Returns the configured nr. of S3 threads, or S3_WORKERS_PER_CPU per available CPU if set to 0 """
+    return configured_workers or S3_WORKERS_PER_CPU * available_cpus()
+
+
+# Measurements only depend on the bucket, they are generated once and copied to each eo3 document
+S2_MEASUREMENT_TEMPLATES = {bucket_name: _generate_s2_measurements(bucket_name)
+                            for bucket_name in S2_MEASUREMENTS}
+
 
 class S2Indexer(ODCIndexer):
     """ Index Sentinel 2 scenes from AWS S3 """
@@ -31,74 +82,140 @@ class S2Indexer(ODCIndexer):
             LOGGER.info(f"Bucket {bucket_name} indexed")
 
     def __index_s3_bucket(self, bucket_name: str):
-        """ Indexes the contents of a single S3 bucket to ODC """
+        """ Indexes the contents of a single S3 bucket to ODC.
+        Keys are listed in a separate thread while the already listed ones are indexed """
         LOGGER.info("Generating indexing queue from config")
-        queue = self.__generate_s3_indexing_queue(bucket_name)
-        q_size = queue.qsize()
-
-        LOGGER.info(f"Indexing {q_size} {bucket_name} tiles")
-        self.__index_from_s3(bucket_name, queue)  # TODO: multithread if necessary
-        LOGGER.info(f"Finished indexing {q_size} {bucket_name} tiles")
-
-    def __generate_s3_indexing_queue(self, bucket_name: str) -> Queue:
-        """ Generates and returns a queue of S3 keys to index """
-        s3 = self.session.resource('s3')
-        bucket = s3.Bucket(bucket_name)
-        queue = Queue()
+        queue = Queue(maxsize=S3_INDEXING_QUEUE_SIZE)
+        stop = Event()
+        with ThreadPoolExecutor(max_workers=1) as lister_executor:
+            lister = lister_executor.submit(self.__fill_s3_indexing_queue, bucket_name, queue, stop)
+            LOGGER.info(f"Indexing {bucket_name} tiles")
+            try:
+                indexed = self.__index_from_s3(bucket_name, queue, lister)
+            finally:
+                stop.set()  # releases listing threads waiting on a full queue if indexing failed
+            lister.result()  # raises errors of the listing thread, the keys after the error weren't indexed
+        LOGGER.info(f"Finished indexing {indexed} {bucket_name} tiles")
+
+    def __fill_s3_indexing_queue(self, bucket_name: str, queue: Queue, stop: Event):
+        """ Puts S3 keys to index to queue, followed by GUARDIAN also if listing fails.
+        Prefixes are listed in parallel, S3 list requests are latency bound. Listing ends when stop is set """
         prefixes = self.__generate_s3_prefixes()
-        for prefix in prefixes:
-            LOGGER.info(f"Fetching metadata for s3://{bucket_name}/{prefix}/*")
-            for obj in bucket.objects.filter(Prefix=prefix, RequestPayer="requester"):
-                if obj.key.endswith("metadata.xml"):
-                    queue.put(obj.key)
+        # clients are thread safe, resources and sessions are not
+        queue_keys = partial(self.__queue_metadata_keys, self.s3_client, bucket_name, queue, stop)
+        LOGGER.info(f"Fetching metadata for {len(prefixes)} daily prefixes of s3://{bucket_name}")
+        try:
+            with ThreadPoolExecutor(max_workers=_s3_workers(config.index.s2_index.list_workers)) as executor:
+                for prefix, keys in executor.map(queue_keys, prefixes):
+                    LOGGER.debug(f"Queued {keys} keys under s3://{bucket_name}/{prefix}")
+        finally:
+            _put_unless_stopped(queue, GUARDIAN, stop)
 
-        queue.put(GUARDIAN)
-        return queue
+    @staticmethod
+    def __queue_metadata_keys(s3_client, bucket_name: str, queue: Queue, stop: Event, prefix: str) -> (str, int):
+        """ Puts the keys of metadata.xml files under a S3 prefix to queue as soon as each page is listed.
+        Returns the prefix and nr. of queued keys. Once stop is set, no more list requests are sent """
+        paginator = s3_client.get_paginator("list_objects_v2")
+        pages = iter(paginator.paginate(Bucket=bucket_name, Prefix=prefix, RequestPayer="requester",
+                                        PaginationConfig={"PageSize": 1000}))
+        keys = 0
+        while not stop.is_set():  # checked before each page, iterating pages sends the list request
+            page = next(pages, None)
+            if page is None:
+                break
+            for obj in page.get("Contents", []):
+                if obj["Key"].endswith("metadata.xml"):
+                    if not _put_unless_stopped(queue, obj["Key"], stop):
+                        return prefix, keys
+                    keys += 1
+        return prefix, keys
 
     @staticmethod
     def __generate_s3_prefixes() -> List[str]:
-        """ Generates a list of S3 bucket prefixes based on config """
+        """ Generates a list of S3 bucket prefixes based on config.
+        Each day has its own prefix, so a month is listed by parallel requests """
         prefixes = []
         for grid in config.index.s2_index.grids:
             a = grid[:2]
             b = grid[2:3]
             c = grid[3:]
             for year in config.index.s2_index.years:
-                prefixes += [f"tiles/{a}/{b}/{c}/{year}/{month}"
-                             for month in config.index.s2_index.months]
+                for month in config.index.s2_index.months:
+                    prefixes += [f"tiles/{a}/{b}/{c}/{year}/{month}/{day}/" for day in range(1, 32)]
         return prefixes
 
-    def __index_from_s3(self, bucket_name: str, queue):
-        """ Indexes S2 tiles from S3 bucket from a queue of keys """
+    def __index_from_s3(self, bucket_name: str, queue: Queue, lister: Future) -> int:
+        """ Indexes S2 tiles from S3 bucket from a queue of keys. Returns nr. of keys handled.
+        metadata.xml files are fetched and parsed in a thread pool,
+        datasets are added to the index from the calling thread """
+        handled = 0
+        fetch_workers = _s3_workers(config.index.s2_index.fetch_workers)
+        pending = set()
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            for keys in self.__queued_key_batches(queue, lister):
+                uris = [self.generate_s3_uri(bucket_name, key) for key in keys]
+                ids = [md5(uri.encode("utf-8")).hexdigest() for uri in uris]
+
+                for key, uri, id_, exists in zip(keys, uris, ids, self.dataset_ids_exist(ids)):
+                    if exists:
+                        LOGGER.info(f"Dataset {key} with id {id_} already indexed, skipping")
+                        continue
+                    pending.add(executor.submit(self.__fetch_eo3_dataset_doc, bucket_name, key, uri, id_))
+                    if len(pending) >= 2 * fetch_workers:  # limit nr. of fetched documents waiting in memory
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        self.__add_fetched_datasets(done)
+                handled += len(keys)
+            self.__add_fetched_datasets(pending)
+        return handled
+
+    @staticmethod
+    def __queued_key_batches(queue: Queue, lister: Future) -> Iterator[List[str]]:
+        """ Yields batches of up to INDEX_CHECK_BATCH_SIZE keys from queue until GUARDIAN.
+        Only the first key of a batch is waited for, the rest are keys already in the queue.
+        Listing may pause for long, e.g. when throttled, so the queue is waited on for as long as lister runs """
         while True:
             try:
                 key = queue.get(timeout=60)
-                if key == GUARDIAN:
-                    break
-                obj = self.get_object_from_s3(bucket_name, key, RequestPayer="requester")
-                data = self.s3obj_to_etree(obj)
-                uri = self.generate_s3_uri(bucket_name, key)
-                id_: str = md5(uri.encode("utf-8")).hexdigest()
-
-                if self.dataset_id_exists(id_):
-                    LOGGER.info(f"Dataset {key} with id {id_} already indexed, skipping")
-                    queue.task_done()
-                else:
-                    dataset_doc = self.__generate_eo3_dataset_doc(bucket_name, uri, data)
-                    self.add_dataset(dataset_doc, uri=uri)
-                    queue.task_done()
             except Empty:
-                break
-            except EOFError:
-                break
+                if lister.done():  # lister always puts GUARDIAN, this only guards against a lost one
+                    return
+                continue
+            batch = []
+            while key != GUARDIAN:
+                batch.append(key)
+                if len(batch) == INDEX_CHECK_BATCH_SIZE:
+                    break
+                try:
+                    key = queue.get_nowait()
+                except Empty:
+                    break
+            if batch:
+                yield batch
+            if key == GUARDIAN:
+                return
+
+    def __fetch_eo3_dataset_doc(self, bucket_name: str, key: str, uri: str, id_: str) -> Tuple[Dict, str]:
+        """ Fetches and parses metadata.xml of a S2 tile, returns the eo3 document and URI of the dataset """
+        obj = self.get_object_from_s3(bucket_name, key, RequestPayer="requester")
+        data = self.s3obj_to_etree(obj)
+        return self.__generate_eo3_dataset_doc(bucket_name, uri, id_, data), uri
 
-    def __generate_eo3_dataset_doc(self, bucket_name: str, uri: str, data: ElementTree) -> dict:
-        """ Generates an eo3 metadata document for ODC indexing """
+    def __add_fetched_datasets(self, futures: Iterable[Future]):
+        """ Adds datasets of completed __fetch_eo3_dataset_doc futures to the index """
+        for future in futures:
+            dataset_doc, uri = future.result()
+            self.add_dataset(dataset_doc, uri=uri)
+
+    def __generate_eo3_dataset_doc(self, bucket_name: str, uri: str, id_: str, data: ElementTree) -> dict:
+        """ Generates an eo3 metadata document for ODC indexing, id_ is the md5 hex digest of uri """
         tile_metadata = self.read_s2_tile_metadata(data)
         grids = self.read_s2_grid_metadata(data)
+        # measurement dicts are copied, relative_s3_keys_to_absolute updates their paths in place
+        measurements = {name: dict(measurement) for name, measurement
+                        in S2_MEASUREMENT_TEMPLATES[bucket_name].items()}
 
         eo3 = {
-            "id": md5(str(uri).encode("utf-8")).hexdigest(),
+            "id": id_,
             "$schema": "https://schemas.opendatacube.org/dataset",
             "product": {
                 "name": S2_PRODUCT_NAMES[bucket_name],
@@ -118,7 +235,7 @@ class S2Indexer(ODCIndexer):
                     "transform": grids["60"]["trans"],
                 },
             },
-            "measurements": self.__generate_s2_measurements(bucket_name),
+            "measurements": measurements,
             "location": uri,
             "properties": {
                 "tile_id": tile_metadata.tile_id,
@@ -137,24 +254,6 @@ class S2Indexer(ODCIndexer):
 
         return self.relative_s3_keys_to_absolute(eo3, uri)
 
-    @staticmethod
-    def __generate_s2_measurements(bucket_name: str) -> Dict:
-        """ Generates a measurement dict for eo3 document """
-        res = {}
-        for measurement in S2_MEASUREMENTS[bucket_name]:
-            band, resolution = measurement.split("_")
-            if bucket_name == L2A_BUCKET:
-                file_name = f"R{resolution}/{band}"
-            else:
-                measurement = file_name = band
-            res[measurement] = {"path": f"{file_name}.jp2"}
-            if resolution == "10m":
-                grid = "default"
-            else:
-                grid = resolution
-            res[measurement]["grid"] = grid
-        return res
-
 
 if __name__ == "__main__":
     LOGGER.info("Starting S2 indexer")
@@ -1,18 +1,18 @@
 import glob
-import os
 from logging import DEBUG
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Set, Tuple
 
 from datacube import Datacube
 from datacube.model import Dataset as ODCDataset
 import numpy as np
 import rasterio as rio
-from rasterio.warp import reproject, Resampling
+from rasterio.enums import Resampling
 from sentinelhub import AwsTile, AwsTileRequest, DataCollection
 
 import cfsi
-from cfsi.utils import check_existing_mask_directory, get_s2_tile_ids
+from cfsi.utils import (cfsi_env, check_existing_mask_directory, find_done_mask_directories, get_s2_tile_ids,
+                        rasterio_read_env)
 from cfsi.utils.logger import create_logger
 from cfsi.utils.write_utils import write_l1c_dataset
 
@@ -23,23 +23,30 @@ LOGGER = create_logger("cloud_mask_generator", level=DEBUG)
 class CloudMaskGenerator:
     l1c_product_name = "s2_level1c_granule"
 
-    def __init__(self):
+    def __init__(self, dc: Optional[Datacube] = None):
+        """ Constructor method
+        :param dc: Datacube used for finding datasets, a new one is created if not given """
+        self.dc = dc
         self.i = 1
         self.indexed_masks: List[ODCDataset] = []
         self.mask_product_name: Optional[str] = None
+        self.mask_band_names: Tuple[str, ...] = ("",)
         self.max_iterations: Optional[int] = None
         self.total_iterations: Optional[int] = None
+        self._done_directories: Optional[Set[Path]] = None
 
     def create_masks(self):
         l1c_datasets = self.get_l1c_datasets()
         if len(l1c_datasets) < self.max_iterations or not self.max_iterations:
             self.max_iterations = len(l1c_datasets)
         self.total_iterations = self.max_iterations
+        self._done_directories = find_done_mask_directories(self.mask_product_name)
 
         for l1c_dataset in l1c_datasets:
             should_continue = self._create_mask(l1c_dataset)
             if not should_continue:
                 break
+        self._finish_masks()
 
         if len(self.indexed_masks) == 0:
             LOGGER.warning("No new masks generated")
@@ -48,8 +55,9 @@ class CloudMaskGenerator:
 
     def get_l1c_datasets(self) -> List[ODCDataset]:
         """ Gets all L1C datasets from ODC Index """
-        dc = Datacube(app="cloud_mask_generator")
-        l1c_datasets = dc.find_datasets(product=self.l1c_product_name)
+        if self.dc is None:  # also used for finding indexed masks in _should_process
+            self.dc = Datacube(app="cloud_mask_generator")
+        l1c_datasets = self.dc.find_datasets(product=self.l1c_product_name)
         return l1c_datasets
 
     def fetch_s2_jp2_files(self, dataset: ODCDataset) -> List[Path]:
@@ -72,7 +80,7 @@ class CloudMaskGenerator:
         :param tile_id: S2 granule tile ID
         :returns Path of fetched data """
         tile_name, time, aws_index = AwsTile.tile_id_to_tile(tile_id)
-        base_output_path = Path(os.environ["CFSI_OUTPUT_CONTAINER"]).joinpath("cache/safe")
+        base_output_path = Path(cfsi_env().output_container).joinpath("cache/safe")
         request = AwsTileRequest(tile=tile_name,
                                  time=time,
                                  aws_index=aws_index,
@@ -87,29 +95,20 @@ class CloudMaskGenerator:
     @staticmethod
     def array_from_jp2_files(jp2_files: List[Path]) -> np.ndarray:
         """ Constructs a np.ndarray from a list of JP2 files """
-        LOGGER.info("Reading and reprojecting data to arrays from JP2 files")
-        arrays = []
-
-        with rio.open(jp2_files[1], nodata=0) as f:  # Read 10m transform from B02
-            data = f.read()
-            dest_transform = f.transform
-            dest_shape = data.shape
-            dest_datatype = data.dtype
-
-        for jp2_file in jp2_files:
-            with rio.open(jp2_file) as f:
-                data = f.read()
-                dest_array = np.zeros(dest_shape, dest_datatype)
-                reproject(data, destination=dest_array,
-                          src_transform=f.transform, dst_transform=dest_transform,
-                          src_crs=f.crs, dst_crs=f.crs,
-                          src_nodata=0, dst_nodata=0,
-                          resampling=Resampling.nearest)
-                arrays.append(dest_array)
+        LOGGER.info("Reading and resampling data to arrays from JP2 files")
+
+        with rasterio_read_env():
+            with rio.open(jp2_files[1]) as f:  # Read 10m shape from B02
+                dest_shape = (f.count, f.height, f.width)
+
+            # (time, y, x, band) layout expected by s2cloudless
+            final_array = np.empty(dest_shape + (len(jp2_files),), dtype=np.float32)
+            for i, jp2_file in enumerate(jp2_files):
+                with rio.open(jp2_file) as f:  # 20m and 60m bands are resampled by the decoder
+                    final_array[..., i] = f.read(out_shape=dest_shape, resampling=Resampling.nearest)
 
         LOGGER.info("Constructing final array")
-        final_array = np.array(arrays, dtype="float64") / 10000
-        final_array = np.moveaxis(final_array, 0, -1)
+        final_array /= 10000
         return final_array
 
     @staticmethod
@@ -117,9 +116,14 @@ class CloudMaskGenerator:
         """ Overridden in subclasses """
         pass
 
+    def _finish_masks(self):
+        """ Called after all datasets have been iterated, overridden in subclasses """
+        pass
+
     def _should_process(self, dataset: ODCDataset) -> bool:
         """ Checks if masks should be generated for given ODCDataset """
-        if check_existing_mask_directory(dataset, self.mask_product_name):
+        if check_existing_mask_directory(dataset, self.mask_product_name, self.mask_band_names,
+                                         self._done_directories, self.dc.index):
             LOGGER.info(f"Existing {self.mask_product_name} files for "
                         f"{dataset.uris[0]}, skipping")
             self.total_iterations -= 1
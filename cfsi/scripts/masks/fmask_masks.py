@@ -1,6 +1,8 @@
 from logging import DEBUG
 from pathlib import Path
+from typing import Optional
 
+from datacube import Datacube
 from datacube.model import Dataset as ODCDataset
 from fmask.cmdline import sentinel2Stacked
 
@@ -16,8 +18,8 @@ LOGGER = create_logger("fmask", level=DEBUG)
 
 class FmaskGenerator(CloudMaskGenerator):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, dc: Optional[Datacube] = None):
+        super().__init__(dc)
         self.max_iterations = config.masks.fmask_masks.max_iterations
         self.mask_product_name = "s2_level1c_fmask"
 
@@ -1,34 +1,76 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import math
 from pathlib import Path
-from typing import Dict
+from typing import Deque, Dict, List, Optional, Tuple
 from logging import DEBUG
+from datacube import Datacube
 from datacube.model import Dataset as ODCDataset
 import numpy as np
 from s2cloudless import S2PixelCloudDetector
 import rasterio as rio
+from rasterio.crs import CRS
+from rasterio.transform import Affine
 
 import cfsi
+from cfsi.exceptions import MaskIndexingException
 from cfsi.scripts.index.s2cloudless_index import S2CloudlessIndexer
 from cfsi.scripts.masks.cloud_mask_generator import CloudMaskGenerator
-from cfsi.utils import get_s2_tile_ids, read_transform_from_file
+from cfsi.utils import get_s2_tile_ids, rasterio_read_env, read_transform_from_file
+from cfsi.utils.kernels import shadow_mask_kernel, shift_mask
 from cfsi.utils.load_datasets import xadataset_from_odcdataset
 from cfsi.utils.logger import create_logger
-from cfsi.utils.write_utils import odcdataset_to_multiple_tif
+from cfsi.utils.write_utils import odcdataset_to_multiple_tif, rio_params_for_xadataset
 
 LOGGER = create_logger("s2cloudless", level=DEBUG)
 
 config = cfsi.config()
 
+# Height of the horizontal strips the image is split to for s2cloudless inference
+S2CLOUDLESS_TILE_ROWS = 1024
+# Rows of overlap between strips, covers s2cloudless averaging and dilation kernels
+S2CLOUDLESS_TILE_OVERLAP = 22
+# Nr. of strips classified at once, bounds peak memory use
+S2CLOUDLESS_WORKERS = 4
+
+
+@lru_cache(maxsize=4)
+def _cloud_detector(threshold: float) -> S2PixelCloudDetector:
+    """ Returns a cached s2cloudless detector, the classifier model is loaded only once per threshold """
+    return S2PixelCloudDetector(threshold=threshold, all_bands=True)
+
 
 class S2CloudlessGenerator(CloudMaskGenerator):
 
-    def __init__(self):
+    def __init__(self, dc: Optional[Datacube] = None):
         """ Constructor method """
-        super().__init__()
+        super().__init__(dc)
         self.max_iterations = config.masks.s2cloudless_masks.max_iterations
         self.mask_product_name = "s2_level1c_s2cloudless"
+        self.mask_band_names = ("clouds", "shadows")
+        self.__workers: int = config.masks.s2cloudless_masks.workers
+        self.__executor: Optional[ProcessPoolExecutor] = None
+        self.__in_progress: Deque[Tuple[ODCDataset, Future]] = deque()
+        self.__pending_index: List[Tuple[ODCDataset, Dict[str, Path]]] = []
+
+    def create_masks(self) -> List[ODCDataset]:
+        """ Generates masks in worker processes, which fetch and classify datasets.
+        Masks are written and indexed in the main process while workers continue with the next datasets """
+        with ProcessPoolExecutor(max_workers=self.__workers, initializer=_init_worker) as executor:
+            self.__executor = executor
+            try:
+                return super().create_masks()
+            except Exception:
+                # index masks already written before the error, without hiding the original exception
+                try:
+                    self.__index_pending()
+                except Exception as err:
+                    LOGGER.error(f"Error indexing written masks after mask generation failed: {err}")
+                raise
 
     def _create_mask(self, l1c_dataset: ODCDataset) -> bool:
-        """ Creates a single mask, returns bool indicating whether to continue iteration """
+        """ Submits a single dataset to the workers, returns bool indicating whether to continue iteration """
         if not config.masks.s2cloudless_masks.generate:
             LOGGER.info("Skipping s2cloudless mask generation due to config")
             return False
@@ -36,98 +78,133 @@ class S2CloudlessGenerator(CloudMaskGenerator):
             return True
 
         LOGGER.info(f"Iteration {self.i}/{self.total_iterations} ({self.max_iterations}): {l1c_dataset.uris[0]}")
-        mask_arrays = self.__process_dataset(l1c_dataset)
-        output_masks = self.__write_masks(l1c_dataset, mask_arrays)
-        self.indexed_masks.append(S2CloudlessIndexer().index_masks(l1c_dataset, output_masks))
+        self.__in_progress.append((l1c_dataset, self.__executor.submit(_generate_masks, l1c_dataset)))
+        while len(self.__in_progress) > self.__workers:  # keep one dataset queued per worker
+            self.__write_next()
 
         return self._continue_iteration()
 
-    def __process_dataset(self, l1c_dataset: ODCDataset) -> (np.ndarray, np.ndarray):
+    def _generate_masks(self, l1c_dataset: ODCDataset) -> ((np.ndarray, np.ndarray), (Affine, CRS)):
+        """ Fetches a dataset and generates its cloud and shadow masks,
+        returns the masks and the transform and CRS for writing them """
+        LOGGER.info("Creating S2 image array")
+        l1c_array, transform = self.__construct_s2_array(l1c_dataset)
+        return self.__process_dataset(l1c_dataset, l1c_array), transform
+
+    def _finish_masks(self):
+        """ Writes and indexes masks of all submitted datasets """
+        while self.__in_progress:
+            self.__write_next()
+        self.__index_pending()
+
+    def __write_next(self):
+        """ Waits for the oldest submitted dataset, then writes and indexes its masks """
+        l1c_dataset, future = self.__in_progress.popleft()
+        try:
+            mask_arrays, transform = future.result()
+        except Exception as err:
+            LOGGER.error(f"Error generating s2cloudless masks for {l1c_dataset.uris[0]}: {err}")
+            raise
+        output_masks = self.__write_masks(l1c_dataset, mask_arrays, transform)
+        if config.masks.s2cloudless_masks.streaming_index:
+            self.indexed_masks.append(S2CloudlessIndexer().index_masks(l1c_dataset, output_masks))
+        else:
+            self.__pending_index.append((l1c_dataset, output_masks))
+
+    def __index_pending(self):
+        """ Indexes written masks that have not been indexed yet.
+        The pending list is cleared first, a failing batch is never submitted again """
+        pending, self.__pending_index = self.__pending_index, []
+        if not pending:
+            return
+        try:
+            self.indexed_masks += S2CloudlessIndexer().index_mask_batch(pending)
+        except MaskIndexingException as err:
+            self.indexed_masks += err.indexed
+            raise
+
+    def __process_dataset(self, l1c_dataset: ODCDataset, l1c_array: np.ndarray) -> (np.ndarray, np.ndarray):
         """ Generate cloud and cloud shadow masks for a single datacube dataset """
         _, s3_key = get_s2_tile_ids(l1c_dataset)
         mean_sun_azimuth = l1c_dataset.metadata_doc["properties"]["mean_sun_azimuth"]
 
-        LOGGER.info("Creating S2 image array")
-        l1c_array = self.__construct_s2_array(l1c_dataset)
         LOGGER.info(f"Generating s2cloudless masks for {s3_key}")
         cloud_masks = self.__generate_cloud_masks(l1c_array)
         LOGGER.info(f"Generating shadow masks for {s3_key}")
         shadow_masks = self.__generate_cloud_shadow_masks(
-            l1c_array[:, :, :, 7], cloud_masks, mean_sun_azimuth)
+            np.squeeze(l1c_array[:, :, :, 7]), cloud_masks, mean_sun_azimuth)
         return cloud_masks, shadow_masks
 
-    def __construct_s2_array(self, dataset: ODCDataset) -> np.ndarray:
-        """ Constructs a np.ndarray from S2 L1C dataset """
+    def __construct_s2_array(self, dataset: ODCDataset) -> (np.ndarray, (Affine, CRS)):
+        """ Constructs a np.ndarray from S2 L1C dataset.
+        Also returns the transform and CRS of the array for writing the masks """
         if not config.masks.s2cloudless_masks.cache:
             ds = xadataset_from_odcdataset(dataset)
-            return np.moveaxis(ds.to_array().values.astype("float64") / 10000, 0, -1)
+            da = ds.to_array().transpose("time", "y", "x", "variable")
+            array = np.ascontiguousarray(da.values, dtype=np.float32)
+            array /= 10000
+            return array, rio_params_for_xadataset(ds)
 
         jp2_files = self.fetch_s2_jp2_files(dataset)
-        return self.array_from_jp2_files(jp2_files)
+        with rasterio_read_env():
+            return self.array_from_jp2_files(jp2_files), read_transform_from_file(jp2_files[1])
 
     @staticmethod
     def __generate_cloud_masks(array: np.ndarray) -> np.ndarray:
-        """ Generate binary cloud masks with s2cloudless """
-        cloud_threshold = config.masks.s2cloudless_masks.cloud_threshold
-        cloud_detector = S2PixelCloudDetector(threshold=cloud_threshold, all_bands=True)
-        return np.squeeze(cloud_detector.get_cloud_masks(array)).astype("byte")
+        """ Generate binary cloud masks with s2cloudless.
+        The image is split to overlapping strips which are classified in parallel threads """
+        cloud_detector = _cloud_detector(config.masks.s2cloudless_masks.cloud_threshold)
+        images, rows, cols = array.shape[:3]
+        cloud_masks = np.empty((images, rows, cols), dtype=np.uint8)
+
+        def classify_tile(start: int):
+            end = min(start + S2CLOUDLESS_TILE_ROWS, rows)
+            tile_start = max(start - S2CLOUDLESS_TILE_OVERLAP, 0)
+            tile_end = min(end + S2CLOUDLESS_TILE_OVERLAP, rows)
+            tile_masks = cloud_detector.get_cloud_masks(array[:, tile_start:tile_end])
+            offset = start - tile_start
+            cloud_masks[:, start:end] = tile_masks[:, offset:offset + end - start]
+
+        with ThreadPoolExecutor(max_workers=S2CLOUDLESS_WORKERS) as executor:
+            list(executor.map(classify_tile, range(0, rows, S2CLOUDLESS_TILE_ROWS)))
+        return np.squeeze(cloud_masks)
 
     @staticmethod
     def __generate_cloud_shadow_masks(nir_array: np.ndarray,
                                       cloud_mask_array: np.ndarray,
                                       mean_sun_azimuth: float) -> np.ndarray:
         """ Generate binary cloud shadow masks """
-        az = np.deg2rad(mean_sun_azimuth)
-        rows, cols = cloud_mask_array.shape
+        az = math.radians(mean_sun_azimuth)
         # calculate how many rows/cols to shift cloud shadow masks
-        x = np.math.cos(az)
-        y = np.math.sin(az)
         cloud_projection_distance = config.masks.s2cloudless_masks.cloud_projection_distance
-        x *= cloud_projection_distance
-        y *= cloud_projection_distance
+        dx = int(math.cos(az) * cloud_projection_distance)
+        dy = int(math.sin(az) * cloud_projection_distance)
 
-        new_rows = np.zeros((abs(int(y)), cols))
-        new_cols = np.zeros((rows, abs(int(x))))
         # TODO: fix issues with projection direction
         # DEBUG - Mean sun azimuth: 133.129531680158. Shifting shadow masks by 21 rows, -20 cols
         # should shift towards top-left, i.e. -21 rows, -20 cols
         LOGGER.debug(f"Mean sun azimuth: {mean_sun_azimuth}. " +
-                     f"Shifting shadow masks by {int(y)} rows, {int(x)} cols")
-        new_rows[:] = 2
-        new_cols[:] = 2
-
-        x, y = int(x), int(y)
-        if y == 0:
-            shadow_mask_array = cloud_mask_array
-        elif y > 0:
-            shadow_mask_array = np.append(cloud_mask_array, new_rows, axis=0)[int(y):, :]
-        else:
-            shadow_mask_array = np.append(new_rows, cloud_mask_array, axis=0)[:-int(y), :]
+                     f"Shifting shadow masks by {dy} rows, {dx} cols")
 
-        if x == 0:
-            pass
-        elif x > 0:
-            shadow_mask_array = np.append(new_cols, shadow_mask_array, axis=1)[:, :-int(x)]
-        else:
-            shadow_mask_array = np.append(shadow_mask_array, new_cols, axis=1)[:, -int(x):]
+        # shadow_mask_array[r, c] = cloud_mask_array[r + dy, c - dx], pixels shifted in from outside are not shadow
+        shadow_mask_array = shift_mask(cloud_mask_array, dy, dx)
 
         dark_pixel_threshold = config.masks.s2cloudless_masks.dark_pixel_threshold
-        dark_pixels = np.squeeze(np.where(nir_array <= dark_pixel_threshold, 1, 0))
-        return np.where((cloud_mask_array == 0) & (shadow_mask_array == 1) & (dark_pixels == 1), 1, 0)
+        out_arr = np.empty_like(cloud_mask_array, dtype=np.uint8)
+        shadow_mask_kernel(cloud_mask_array, shadow_mask_array, nir_array, dark_pixel_threshold, out_arr)
+        return out_arr
 
     def __write_masks(self, l1c_dataset: ODCDataset,
-                      mask_arrays: (np.ndarray, np.ndarray)) -> Dict[str, Path]:
-        """ Writes cloud and shadow masks to files """
+                      mask_arrays: (np.ndarray, np.ndarray),
+                      transform: (Affine, CRS)) -> Dict[str, Path]:
+        """ Writes cloud and shadow masks to files using transform and CRS read with the input array """
         masks = {"clouds": mask_arrays[0],
                  "shadows": mask_arrays[1]}
 
-        transform = None
-        if config.masks.s2cloudless_masks.cache:
-            transform = read_transform_from_file(self.fetch_s2_jp2_files(l1c_dataset)[1])
-
         output_mask_files = odcdataset_to_multiple_tif(
             l1c_dataset, masks, product_name=self.mask_product_name,
-            data_type=rio.ubyte, custom_transform=transform)
+            data_type=rio.ubyte, custom_transform=transform,
+            compress="deflate", predictor=2)
 
         output_masks = {
             "cloud_mask": output_mask_files[0],
@@ -138,5 +215,21 @@ class S2CloudlessGenerator(CloudMaskGenerator):
         return output_masks
 
 
+# Generator of a worker process, kept for all datasets processed by the worker
+_worker_generator: Optional[S2CloudlessGenerator] = None
+
+
+def _init_worker():
+    """ Sets up a worker process, loads the s2cloudless classifier before the first dataset arrives """
+    global _worker_generator
+    _worker_generator = S2CloudlessGenerator()
+    _cloud_detector(config.masks.s2cloudless_masks.cloud_threshold)
+
+
+def _generate_masks(l1c_dataset: ODCDataset) -> ((np.ndarray, np.ndarray), (Affine, CRS)):
+    """ Generates masks for a single dataset, run in worker processes """
+    return _worker_generator._generate_masks(l1c_dataset)
+
+
 if __name__ == "__main__":
     S2CloudlessGenerator().create_masks()
@@ -1,10 +1,12 @@
-import os
 from datetime import datetime, date, timedelta
+from functools import partial
 from logging import DEBUG
+import os
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from uuid import UUID
 
+import dask
 from datacube import Datacube
 from datacube.model import Dataset as ODCDataset
 import numpy as np
@@ -12,10 +14,12 @@ import rasterio as rio
 import xarray as xa
 
 import cfsi
-from cfsi.exceptions import ProductNotFoundException
-from cfsi.utils.load_datasets import xadataset_from_odcdataset, odcdataset_from_uri
+from cfsi.utils import available_cpus, cfsi_env
+from cfsi.utils.kernels import mosaic_kernel, mosaic_kernel_no_recentness
+from cfsi.utils.load_datasets import xadataset_from_odcdataset, odcdatasets_from_uris
 from cfsi.utils.logger import create_logger
-from cfsi.utils.write_utils import array_to_geotiff, rio_params_for_xadataset, create_overviews
+from cfsi.utils.write_utils import (array_to_geotiff, cog_driver_available, create_overviews,
+                                    rio_params_for_xadataset)
 
 LOGGER = create_logger("mosaic", level=DEBUG)
 
@@ -23,13 +27,48 @@ LOGGER = create_logger("mosaic", level=DEBUG)
 config = cfsi.config()
 
 
+# Mask bands needed for creating the valid pixel mask of each mask product
+MASK_BANDS = {
+    "s2_level1c_s2cloudless": ["cloud_mask", "shadow_mask"],
+    "s2_level1c_fmask": ["fmask"],
+    "s2_sen2cor_granule": ["SCL_20m"],
+}
+# Values of categorical mask bands marking pixels usable in the mosaic
+VALID_MASK_VALUES = {
+    "s2_level1c_fmask": (1, 4, 5),  # clear land, water, snow
+    "s2_sen2cor_granule": (2, 4, 5, 6, 11),  # dark area, vegetation, not vegetated, water, snow
+}
+# Chunks of the lazily loaded mosaic datacube, each time slice is read in spatial blocks by parallel threads
+MOSAIC_DASK_CHUNKS = {"time": 1, "y": 2048, "x": 2048}
+
+
+def _valid_from_lookup(mask: xa.DataArray, valid_values: Tuple[int, ...]) -> xa.DataArray:
+    """ Returns a lazy boolean array of mask pixels having one of valid_values.
+    Each pixel is looked up from a table in a single pass, instead of comparing the whole array to each value.
+    The last table entry is False, values larger than the table are clipped to it """
+    lookup_table = np.zeros(max(valid_values) + 2, dtype=bool)
+    lookup_table[list(valid_values)] = True
+    return xa.apply_ufunc(partial(np.take, lookup_table, mode="clip"), mask,
+                          dask="parallelized", output_dtypes=[bool])
+
+
+def _format_pixel_count(pixels: int) -> str:
+    """ Formats a pixel count for logging, e.g. 950p or 120.6Mp """
+    if pixels < 1000000:
+        return f"{pixels}p"
+    return f"{pixels / 1000000:.1f}Mp"
+
+
 class MosaicCreator:
 
     def __init__(self,
                  mask_product_name: str,
                  date_: str = "today",
-                 days: int = 30):
-        """ Constructor method """
+                 days: int = 30,
+                 dc: Optional[Datacube] = None):
+        """ Constructor method
+        :param dc: Datacube used for finding mask datasets, a new one is created if not given """
+        self.__dc = dc
         self.__product_name = mask_product_name
         self.__use_masks = True
         if mask_product_name == "scl":
@@ -47,7 +86,7 @@ class MosaicCreator:
 
     def __get_mask_datasets(self) -> List[ODCDataset]:
         """ Finds mask datasets based on config """
-        dc = Datacube(app="mosaic_creator")
+        dc = self.__dc or Datacube(app="mosaic_creator")
         time_range = (str(self.__start_date), str(self.__end_date))
         datasets = dc.find_datasets(product=self.__product_name, time=time_range)
         if not datasets:
@@ -61,153 +100,175 @@ class MosaicCreator:
         LOGGER.info(f"Creating {self.__product_name} mosaic dataset "
                     f"from {len(self.__mask_datasets)} masks "
                     f"from {self.__start_date} to {self.__end_date}")
+        recentness: int = config.mosaic.recentness
+        output_bands = config.mosaic.output_bands
         ds = self.__setup_mask_datacube()
+        valid = None
         if self.__use_masks:
-            ds = self.__apply_mask(ds)
+            ds = ds[output_bands + MASK_BANDS[self.__product_name]]
+            valid = self.__valid_mask(ds)
+        else:
+            ds = ds[output_bands]
 
-        ds_out: xa.Dataset = ds.copy(deep=True).isel(time=-1)
-        recentness: int = config.mosaic.recentness
-        output_bands = config.mosaic.output_bands
-        i = 1
-
-        for band in output_bands:
-            LOGGER.info(f"Creating {self.__product_name} mosaic for band {band}, {i}/{len(output_bands)}")
-            mosaic_da = self.__mosaic_from_data_array(ds[band], recentness=recentness)
-            ds_out[band].values = mosaic_da[band].values
-            if recentness:
-                if recentness == 1:
-                    ds_out["recentness"] = mosaic_da[f"{band}_recentness"]
-                    LOGGER.info("Generated recentness array once")
-                    recentness = 0
-                else:
-                    ds_out[f"{band}_recentness"] = mosaic_da[f"{band}_recentness"]
-                    LOGGER.info(f"Generated recentness array for band {band}")
-            i += 1
-            # nodata_pixels = np.count_nonzero(ds_out[band].values == 0)
-            # LOGGER.debug(f"Nodata pixels remaining: {nodata_pixels}")
-            # if nodata_pixels == 0:
-            #     LOGGER.info(f"All pixels filled for band {band}, continuing to next band")
-            #     continue
+        ds_out: xa.Dataset = ds[output_bands].isel(time=-1)
+        LOGGER.info(f"Creating {self.__product_name} mosaic for bands {', '.join(output_bands)}")
+        mosaic_arr, recentness_arr = self.__mosaic_from_data_array(ds[output_bands].to_array(), valid,
+                                                                   with_recentness=bool(recentness))
+        # replace band data with the mosaic, keeping coordinates and attributes
+        ds_out = ds_out.assign({band: ds_out[band].copy(data=mosaic_arr[i])
+                                for i, band in enumerate(output_bands)})
+
+        template = ds_out[output_bands[0]]
+        if recentness == 1:
+            ds_out["recentness"] = xa.DataArray(recentness_arr, coords=template.coords, dims=template.dims)
+            LOGGER.info("Generated recentness array once")
+        elif recentness:
+            for band in output_bands:  # all bands share the same recentness buffer
+                ds_out[f"{band}_recentness"] = xa.DataArray(recentness_arr, coords=template.coords,
+                                                            dims=template.dims)
+            LOGGER.info("Generated recentness array for all bands")
 
         LOGGER.info("Mosaic creation finished")
-        ds_out = ds_out.drop_vars(key for key in ds_out.data_vars.keys()
-                                  if key not in output_bands and "recentness" not in key)
         return ds_out
 
     def __setup_mask_datacube(self) -> xa.Dataset:
-        """ Creates a datacube with L2A S2 bands and cloud masks """
+        """ Creates a lazy datacube with L2A S2 bands and cloud masks """
         if self.__product_name == "s2_sen2cor_granule":
             return self.__setup_l2a_datacube()
         mask_dict = self.__generate_mask_dict()
         mask_dataset_ids = list(mask_dict.keys())
         l2a_dataset_ids = list(mask_dict.values())
 
-        ds_l2a = xadataset_from_odcdataset(ids=l2a_dataset_ids)
-        ds_mask = xadataset_from_odcdataset(ids=mask_dataset_ids)
+        ds_l2a = xadataset_from_odcdataset(ids=l2a_dataset_ids, measurements=config.mosaic.output_bands,
+                                           dask_chunks=MOSAIC_DASK_CHUNKS)
+        ds_mask = xadataset_from_odcdataset(ids=mask_dataset_ids, measurements=MASK_BANDS[self.__product_name],
+                                            dask_chunks=MOSAIC_DASK_CHUNKS)
         return ds_l2a.merge(ds_mask)
 
     def __setup_l2a_datacube(self) -> xa.Dataset:
-        """ Creates a datacube with only L2A datasets for SCL mosaics """
+        """ Creates a lazy datacube with only L2A datasets for SCL mosaics """
         ids = [ds.id for ds in self.__mask_datasets]
-        return xadataset_from_odcdataset(ids=ids)
+        measurements = config.mosaic.output_bands
+        if self.__use_masks:
+            measurements = measurements + MASK_BANDS[self.__product_name]
+        return xadataset_from_odcdataset(ids=ids, measurements=measurements, dask_chunks=MOSAIC_DASK_CHUNKS)
 
     def __generate_mask_dict(self) -> Dict[UUID, UUID]:
         """ Generates a dict of mask_dataset.id: l2a_dataset.id """
+        properties = {mask_dataset.id: mask_dataset.metadata_doc["properties"]
+                      for mask_dataset in self.__mask_datasets}
+        missing_uris = [props["l2a_uri"] for props in properties.values() if not props["l2a_dataset_id"]]
+        l2a_datasets = {}
+        if missing_uris:
+            LOGGER.info(f"L2A dataset id not provided for {len(missing_uris)} masks, searching using URI")
+            l2a_datasets = odcdatasets_from_uris(missing_uris, "s2_sen2cor_granule")
+
         mask_dict = {}
-        for mask_dataset in self.__mask_datasets:
-            l2a_dataset_id = mask_dataset.metadata_doc["properties"]["l2a_dataset_id"]
+        for mask_dataset_id, props in properties.items():
+            l2a_dataset_id = props["l2a_dataset_id"]
             if not l2a_dataset_id:
-                try:
-                    LOGGER.info("L2A dataset id not provided, searching using URI")
-                    l2a_uri = mask_dataset.metadata_doc["properties"]["l2a_uri"]
-                    l2a_dataset_id = odcdataset_from_uri(l2a_uri, "s2_sen2cor_granule").id
-                except ProductNotFoundException:
-                    LOGGER.warning(f"L2A dataset not in index, skipping mask {mask_dataset}")
+                if props["l2a_uri"] not in l2a_datasets:
+                    LOGGER.warning(f"L2A dataset not in index, skipping mask {mask_dataset_id}")
                     continue
-            mask_dict[mask_dataset.id] = l2a_dataset_id
+                l2a_dataset_id = l2a_datasets[props["l2a_uri"]].id
+            mask_dict[mask_dataset_id] = l2a_dataset_id
         return mask_dict
 
-    def __apply_mask(self, ds: xa.Dataset) -> xa.Dataset:
-        """ """
+    def __valid_mask(self, ds: xa.Dataset) -> xa.DataArray:
+        """ Returns a lazy (time, y, x) boolean array of pixels not masked out by the mask product """
         if self.__product_name == "s2_level1c_s2cloudless":
-            return ds.where((ds.cloud_mask == 0) & (ds.shadow_mask == 0), 0)
+            return (ds.cloud_mask | ds.shadow_mask) == 0
         elif self.__product_name == "s2_level1c_fmask":
-            return ds.where((ds.fmask == 1) | (ds.fmask == 4) | (ds.fmask == 5), 0)
+            return _valid_from_lookup(ds.fmask, VALID_MASK_VALUES[self.__product_name])
         elif self.__product_name == "s2_sen2cor_granule":
-            return ds.where((ds.SCL_20m == 2) | (ds.SCL_20m == 4) | (ds.SCL_20m == 5) | (ds.SCL_20m == 6) | (ds.SCL_20m == 11), 0)
+            return _valid_from_lookup(ds.SCL_20m, VALID_MASK_VALUES[self.__product_name])
         raise ValueError("Invalid mask product name")  # TODO: custom exception
 
     @staticmethod
-    def __mosaic_from_data_array(da_in: xa.DataArray, recentness: int = 0) -> xa.Dataset:
-        """ Creates a most-recent-to-oldest mosaic of the input dataset.
-            da_in: A xa.DataArray retrieved from the Data Cube; should contain:
-            coordinates: time, latitude, longitude """
-        da_in = da_in.copy(deep=True)
-        da_out = da_in.isel(time=-1).copy(deep=True)  # TODO: check if .drop("time" is needed
-        out_arr = da_out.values
-        recentness_arr = None
-        cols, rows = da_out.sizes['x'], da_out.sizes['y']
+    def __mosaic_from_data_array(da_in: xa.DataArray, valid: xa.DataArray = None,
+                                 with_recentness: bool = True) -> (np.ndarray, Optional[np.ndarray]):
+        """ Creates a most-recent-to-oldest mosaic of all bands of the input data array at once.
+            da_in: A xa.DataArray retrieved from the Data Cube with Dataset.to_array(); should contain:
+            coordinates: variable, time, latitude, longitude
+            valid: (time, y, x) boolean array of pixels to use, all pixels are used if not given
+            with_recentness: whether to create the recentness array
+            Returns a (band, y, x) mosaic array and a (y, x) recentness array, or None without recentness """
+        bands, cols, rows = da_in.sizes['variable'], da_in.sizes['x'], da_in.sizes['y']
         LOGGER.info(f"Mosaic array shape (x, y): {cols, rows}")
-        total_pixels = f"{round((cols * rows) / 1000000)}Mp"
+        total_pixels = _format_pixel_count(cols * rows)
 
-        if recentness:
-            latest_time = da_in.time[-1].values.astype('datetime64[D]').astype('uint16')
-            recentness_arr = np.empty((rows, cols), dtype=np.uint16)
-            recentness_arr[:] = latest_time
+        times = da_in.time.values.astype('datetime64[D]').astype('uint16')
+        out_arr = np.zeros((bands, rows, cols), dtype=np.uint16)  # S2 reflectances are uint16
+        recentness_arr = np.full((rows, cols), times[-1], dtype=np.uint16) if with_recentness else None
+        all_valid = np.broadcast_to(True, (rows, cols))
 
-        for index in range(len(da_in.time) - 2, -1, -1):
-            nodata_pixels = np.count_nonzero(out_arr == 0)
+        # load one time slice of all bands at a time, from most recent to oldest.
+        # a vectorized argmax over the whole (time, band, y, x) stack would need all slices in memory
+        # and can't stop at nodata_cutoff, the kernel does the same fill in a single pass per slice
+        dask_workers = config.mosaic.dask_workers or available_cpus()
+        for index in range(len(times) - 1, -1, -1):
+            # bands and masks of the slice are read in parallel in a single dask computation
+            if valid is None:
+                data_slice, = dask.compute(da_in.isel(time=index).data,
+                                           scheduler="threads", num_workers=dask_workers)
+                valid_slice = all_valid
+            else:
+                data_slice, valid_slice = dask.compute(da_in.isel(time=index).data, valid.isel(time=index).data,
+                                                       scheduler="threads", num_workers=dask_workers)
+            data_slice = np.ascontiguousarray(data_slice, dtype=np.uint16)
+            if with_recentness:
+                nodata_pixels = mosaic_kernel(data_slice, valid_slice, times[index], out_arr, recentness_arr)
+            else:
+                nodata_pixels = mosaic_kernel_no_recentness(data_slice, valid_slice, out_arr)
+            # nodata count is returned by the kernel, logging doesn't scan the mosaic
+            LOGGER.info(f"Index {index}/{len(times) - 1}; "
+                        "Nodata pixels remaining: "
+                        f"{_format_pixel_count(nodata_pixels)}/{total_pixels}")
             if nodata_pixels <= config.mosaic.nodata_cutoff:
                 LOGGER.info(f"Nr. of pixels with missing data ({nodata_pixels}"
                             f" less than cutoff value {config.mosaic.nodata_cutoff},"
-                            f" finishing band")
+                            f" finishing mosaic")
                 break
 
-            if nodata_pixels > 1000000:
-                nodata_pixels = str(round(nodata_pixels/1000000)) + 'Mp'
-            else:
-                nodata_pixels = str(nodata_pixels) + 'p'
-            LOGGER.info(f"Index {index}/{len(da_in.time) - 2}; "
-                        "Nodata pixels remaining: "
-                        f"{nodata_pixels}/{total_pixels}")
-
-            da_slice = da_in.isel(time=index)
-            if recentness:
-                da_slice_time = da_in.time[index].values.astype('datetime64[D]').astype('uint16')
-                recentness_arr[out_arr == 0] = da_slice_time
-            out_arr[out_arr == 0] = da_slice.values[out_arr == 0]
-
-        da_out.values = out_arr
-        if recentness:
-            recentness_data = da_out.copy(deep=True).rename(f"{da_out.name}_recentness")
-            recentness_data.values = recentness_arr
-            return xa.merge([da_out, recentness_data])
-
-        return da_out.to_dataset()
+        return out_arr, recentness_arr
 
     def write_mosaic_to_file(self, mosaic_ds: xa.Dataset) -> Path:
         """ Creates a new mosaic from a list of S2Cloudless mask ODC Datasets """
         file_path = self.__generate_mosaic_output_path()
 
-        LOGGER.info("Constructing mosaic array")
-        data: List[np.ndarray] = [np.squeeze(mosaic_ds[band].values)
-                                  for band in mosaic_ds.data_vars]
-        geo_transform, projection = rio_params_for_xadataset(mosaic_ds)
+        try:
+            LOGGER.info("Constructing mosaic array")
+            # band arrays are passed as is, they are written one tile at a time without stacking them to a new array
+            data: List[np.ndarray] = [mosaic_ds[band].values for band in mosaic_ds.data_vars]
+            geo_transform, projection = rio_params_for_xadataset(mosaic_ds)
 
-        LOGGER.info(f"Writing mosaic to {file_path}")
-        array_to_geotiff(file_path, data, geo_transform, projection,
-                         compress="none", data_type=rio.uint16)
-        create_overviews(file_path)
+            LOGGER.info(f"Writing mosaic to {file_path}")
+            cog = cog_driver_available()  # COG builds the overviews while writing, without reading the file back
+            array_to_geotiff(file_path, data, geo_transform, projection,
+                             compress="zstd", predictor=2, data_type=rio.uint16, cog=cog)
+            if not cog:
+                create_overviews(file_path)
+        except BaseException:
+            # remove the reserved or partially written file, it would look like a finished mosaic
+            LOGGER.error(f"Writing mosaic {file_path} failed, removing the file")
+            file_path.unlink(missing_ok=True)
+            raise
         LOGGER.info(f"Generated mosaic {file_path}")
         return file_path
 
     def __generate_mosaic_output_path(self) -> Path:
-        """ Generates an output Path for a new mosaic """
-        base_output_path = Path(os.environ["CFSI_OUTPUT_CONTAINER"])
+        """ Generates an output Path for a new mosaic. The file is created empty with O_EXCL to reserve
+        its name, concurrent mosaic processes never get the same path """
+        base_output_path = Path(cfsi_env().output_container)
         mosaic_dir = Path(base_output_path / "mosaics")
-        i = 0
-        file_path = Path(mosaic_dir / f"{self.__end_date}_{self.__product_name}_{i}.tif")
-        while file_path.exists():
-            i += 1
-            file_path = Path(mosaic_dir / f"{self.__end_date}_{self.__product_name}_{i}.tif")
-        return file_path
+        mosaic_dir.mkdir(parents=True, exist_ok=True)
+        prefix = f"{self.__end_date}_{self.__product_name}_"
+        counters = [file_path.stem[len(prefix):] for file_path in mosaic_dir.glob(f"{prefix}*.tif")]
+        i = max((int(counter) for counter in counters if counter.isdigit()), default=-1) + 1
+        while True:
+            file_path = Path(mosaic_dir / f"{prefix}{i}.tif")
+            try:
+                os.close(os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return file_path
+            except FileExistsError:
+                i += 1
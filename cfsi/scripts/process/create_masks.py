@@ -1,11 +1,17 @@
+from typing import Optional
+
+from datacube import Datacube
+
 from cfsi.scripts.masks.fmask_masks import FmaskGenerator
 from cfsi.scripts.masks.s2cloudless_masks import S2CloudlessGenerator
 
 
-def create_masks():
-    """ Generate s2cloudless masks """
-    S2CloudlessGenerator().create_masks()
-    FmaskGenerator().create_masks()
+def create_masks(dc: Optional[Datacube] = None):
+    """ Generate s2cloudless masks
+    :param dc: Datacube shared by the mask generators, optional """
+    dc = dc or Datacube(app="create_masks")
+    S2CloudlessGenerator(dc).create_masks()
+    FmaskGenerator(dc).create_masks()
 
 
 if __name__ == "__main__":
@@ -1,22 +1,60 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Optional, Tuple
+
+from datacube import Datacube
+import xarray as xa
+
 import cfsi
 from cfsi.scripts.index.mosaic_index import MosaicIndexer
 from cfsi.scripts.mosaic import MosaicCreator
+from cfsi.utils.logger import create_logger
 
 config = cfsi.config()
+LOGGER = create_logger("create_mosaics")
 
 
-def create_mosaics():
-    """ Creates cloudless mosaics from masks """
+def create_mosaics(dc: Optional[Datacube] = None):
+    """ Creates cloudless mosaics from masks.
+    With mosaic.workers > 1 mosaics are created in parallel processes and indexed in the main process
+    :param dc: Datacube shared by the mosaic creators, used only when mosaics are created sequentially """
     dates = config.mosaic.dates
     days = config.mosaic.range
     products = config.mosaic.products
+    workers = config.mosaic.workers
+
+    if workers <= 1:
+        dc = dc or Datacube(app="create_mosaics")
+        for product in products:
+            for date_ in dates:
+                MosaicIndexer().index_mosaic(*_create_mosaic(product, date_, days, dc))
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_create_mosaic, product, date_, days, metadata_only=True): (product, date_)
+                   for product in products for date_ in dates}
+        errors = []
+        for future in as_completed(futures):  # mosaics written by the other workers are indexed before raising
+            try:
+                MosaicIndexer().index_mosaic(*future.result())
+            except Exception as err:
+                product, date_ = futures[future]
+                LOGGER.error(f"Error creating or indexing {product} mosaic for {date_}: {err}")
+                errors.append(err)
+        if errors:
+            raise errors[0]
+
 
-    for product in products:
-        for date_ in dates:
-            mosaic_creator = MosaicCreator(product, date_, days)
-            mosaic_ds = mosaic_creator.create_mosaic_dataset()
-            output_mosaic_path = mosaic_creator.write_mosaic_to_file(mosaic_ds)
-            MosaicIndexer().index_mosaic(mosaic_ds, output_mosaic_path)
+def _create_mosaic(product: str, date_: str, days: int, dc: Optional[Datacube] = None,
+                   metadata_only: bool = False) -> Tuple[xa.Dataset, Path]:
+    """ Creates and writes a single mosaic, returns the mosaic dataset and output path for indexing
+    :param metadata_only: drop band data from the returned dataset, when returned from a worker process """
+    mosaic_creator = MosaicCreator(product, date_, days, dc=dc)
+    mosaic_ds = mosaic_creator.create_mosaic_dataset()
+    output_mosaic_path = mosaic_creator.write_mosaic_to_file(mosaic_ds)
+    if metadata_only:  # indexing needs only coordinates and CRS, the written bands aren't sent back
+        mosaic_ds = mosaic_ds.drop_vars(list(mosaic_ds.data_vars))
+    return mosaic_ds, output_mosaic_path
 
 
 if __name__ == "__main__":
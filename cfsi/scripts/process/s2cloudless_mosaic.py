@@ -1,11 +1,14 @@
+from datacube import Datacube
+
 from cfsi.scripts.process.create_mosaics import create_mosaics
 from cfsi.scripts.process.create_masks import create_masks
 
 
 def main():
     """ Generate s2cloudless masks and create cloudless mosaics """
-    create_masks()
-    create_mosaics()
+    dc = Datacube(app="cfsi")
+    create_masks(dc)
+    create_mosaics(dc)
     exit(0)
 
 
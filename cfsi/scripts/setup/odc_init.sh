@@ -7,3 +7,6 @@ datacube -v system init
 for product in cfsi/products/*.yaml; do
   datacube product add "$product"
 done
+
+# compile numba kernels to disk cache
+python3 -m cfsi.utils.kernels
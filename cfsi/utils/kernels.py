@@ -0,0 +1,82 @@
+""" Numba kernels for the pixel-wise hot loops of mask and mosaic generation.
+Compiled kernels are cached to disk, run this module once (done in odc_init.sh)
+to compile them ahead of the first mask or mosaic run """
+
+from numba import njit, prange
+import numpy as np
+
+
+@njit(parallel=True, cache=True)
+def mosaic_kernel(data: np.ndarray, valid: np.ndarray, time: int,
+                  out_arr: np.ndarray, recentness_arr: np.ndarray) -> int:
+    """ Fills nodata pixels of out_arr with valid nonzero values of a single (band, y, x) time slice,
+    and sets recentness_arr of the filled pixels to time. The first band decides whether a pixel has data.
+    Returns nr. of pixels still without data """
+    bands, rows, cols = data.shape
+    nodata_pixels = 0
+    for y in prange(rows):
+        for x in range(cols):
+            if out_arr[0, y, x] == 0:
+                if valid[y, x] and data[0, y, x] != 0:
+                    for b in range(bands):
+                        out_arr[b, y, x] = data[b, y, x]
+                    recentness_arr[y, x] = time
+                else:
+                    nodata_pixels += 1
+    return nodata_pixels
+
+
+@njit(parallel=True, cache=True)
+def mosaic_kernel_no_recentness(data: np.ndarray, valid: np.ndarray, out_arr: np.ndarray) -> int:
+    """ mosaic_kernel for mosaics without a recentness band, skips the recentness writes.
+    Returns nr. of pixels still without data """
+    bands, rows, cols = data.shape
+    nodata_pixels = 0
+    for y in prange(rows):
+        for x in range(cols):
+            if out_arr[0, y, x] == 0:
+                if valid[y, x] and data[0, y, x] != 0:
+                    for b in range(bands):
+                        out_arr[b, y, x] = data[b, y, x]
+                else:
+                    nodata_pixels += 1
+    return nodata_pixels
+
+
+@njit(parallel=True, cache=True)
+def shadow_mask_kernel(cloud_mask_array: np.ndarray, shadow_mask_array: np.ndarray,
+                       nir_array: np.ndarray, dark_pixel_threshold: float, out_arr: np.ndarray):
+    """ Marks dark, cloudless pixels under a projected cloud as shadow in a single pass """
+    rows, cols = cloud_mask_array.shape
+    for y in prange(rows):
+        for x in range(cols):
+            out_arr[y, x] = (cloud_mask_array[y, x] == 0 and shadow_mask_array[y, x] == 1 and
+                             nir_array[y, x] <= dark_pixel_threshold)
+
+
+def shift_mask(mask: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """ Returns a copy of a 2D mask shifted by dy rows up and dx columns right, i.e. out[r, c] = mask[r + dy, c - dx].
+    Pixels shifted in from outside the mask are 0. A plain slice copy, runs at memory speed without numba """
+    rows, cols = mask.shape
+    shifted = np.zeros_like(mask)
+    if abs(dy) < rows and abs(dx) < cols:
+        shifted[max(0, -dy):rows - max(0, dy), max(0, dx):cols - max(0, -dx)] = \
+            mask[max(0, dy):rows - max(0, -dy), max(0, -dx):cols - max(0, dx)]
+    return shifted
+
+
+def compile_kernels():
+    """ Compiles the kernels to the disk cache by calling them with the argument types used at runtime """
+    data = np.zeros((1, 2, 2), dtype=np.uint16)
+    recentness_arr = np.zeros((2, 2), dtype=np.uint16)
+    for valid in (np.ones((2, 2), dtype=bool), np.broadcast_to(True, (2, 2))):
+        mosaic_kernel(data, valid, np.uint16(0), np.zeros_like(data), recentness_arr)
+        mosaic_kernel_no_recentness(data, valid, np.zeros_like(data))
+
+    mask = np.zeros((2, 2), dtype=np.uint8)
+    nir_array = np.zeros((1, 2, 2, 13), dtype=np.float32)[0, :, :, 7]  # band view of the L1C array
+    shadow_mask_kernel(mask, mask, nir_array, 0.0, np.empty_like(mask))
+
+
+if __name__ == "__main__":
+    compile_kernels()
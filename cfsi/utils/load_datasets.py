@@ -1,4 +1,7 @@
-from typing import List, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import os
+from typing import Dict, List, Optional, Union
 
 from uuid import UUID
 from datacube import Datacube
@@ -8,9 +11,22 @@ import xarray as xa
 from cfsi.exceptions import ProductNotFoundException
 
 
+def get_datacube(app: str) -> Datacube:
+    """ Returns a Datacube connected to the ODC index, shared by all calls with the same app name in a process """
+    return _cached_datacube(app, os.getpid())
+
+
+@lru_cache(maxsize=8)
+def _cached_datacube(app: str, _pid: int) -> Datacube:
+    """ Keyed also by process id, so forked worker processes don't reuse database connections of their parent """
+    return Datacube(app=app)
+
+
+@lru_cache(maxsize=4096)
 def odcdataset_from_uri(uri: str, product: str = None) -> ODCDataset:
-    """ Returns the id of a ODCDataset that matches the given URI """
-    dc = Datacube(app="dataset_from_uri")
+    """ Returns the id of a ODCDataset that matches the given URI.
+    Found datasets are cached, clear with odcdataset_from_uri.cache_clear() after re-indexing """
+    dc = get_datacube("dataset_from_uri")
     query = dict(product=product, uri=uri, limit=1)
     try:
         dataset: ODCDataset = [odc_ds for odc_ds in dc.index.datasets.search(**query)][0]
@@ -19,22 +35,41 @@ def odcdataset_from_uri(uri: str, product: str = None) -> ODCDataset:
     return dataset
 
 
+def odcdatasets_from_uris(uris: List[str], product: str = None, workers: int = 8) -> Dict[str, ODCDataset]:
+    """ Searches ODCDatasets matching multiple URIs with a single Datacube connection.
+    Searches are run in parallel threads, URIs without a matching dataset are left out of the result
+    :return: dict of uri: ODCDataset """
+    dc = get_datacube("datasets_from_uris")
+
+    def search(uri: str) -> Optional[ODCDataset]:
+        return next(iter(dc.index.datasets.search(product=product, uri=uri, limit=1)), None)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        datasets = executor.map(search, uris)
+        return {uri: dataset for uri, dataset in zip(uris, datasets) if dataset is not None}
+
+
 def xadataset_from_odcdataset(
         datasets: Union[List[ODCDataset], ODCDataset] = None,
         ids: Union[List[UUID], UUID] = None,
-        measurements: List[str] = None) -> xa.Dataset:
-    """ Loads a xaDataset from ODCDatasets or ODCDataset ids
+        measurements: List[str] = None,
+        dask_chunks: Dict[str, int] = None) -> xa.Dataset:
+    """ Loads a lazy, dask backed xaDataset from ODCDatasets or ODCDataset ids
      :param datasets: ODCDataset(s), optional
      :param ids: ODCDataset id(s), optional
      :param measurements: list of measurements/bands to load, optional
+     :param dask_chunks: dask chunk size per dimension, e.g. {"time": 1, "y": 2048, "x": 2048},
+      defaults to a single chunk per band and time, optional
      :return: xa.Dataset containing given ODCDatasets or IDs """
 
-    dc = Datacube(app="dataset_from_ODCDataset")
+    dc = get_datacube("dataset_from_ODCDataset")
 
     if not datasets:
         if not isinstance(ids, list):
             ids = [ids]
-        datasets = [dc.index.datasets.get(id_) for id_ in ids]
+        # ids may be given as UUIDs or strings, keep order of given ids
+        datasets_by_id = {str(dataset.id): dataset for dataset in dc.index.datasets.bulk_get(ids)}
+        datasets = [datasets_by_id[str(id_)] for id_ in ids if str(id_) in datasets_by_id]
 
     if not isinstance(datasets, list):
         datasets = [datasets]
@@ -44,7 +79,7 @@ def xadataset_from_odcdataset(
     res = (10, -10)  # TODO: handle other resolutions
 
     ds = dc.load(product=product_name,
-                 dask_chunks={},
+                 dask_chunks=dask_chunks or {},
                  measurements=measurements,
                  output_crs=str(crs),
                  resolution=res,
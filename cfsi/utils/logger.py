@@ -2,32 +2,43 @@ import logging
 import os
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from typing import Set
+
+# Names of loggers that already have their handlers
+_CONFIGURED_LOGGERS: Set[str] = set()
+# Formatter shared by all handlers
+_FORMATTER = logging.Formatter('%(asctime)s %(levelname)8s %(name)20s - %(message)s')
+# Set once the log directory has been created
+_log_dir_ready = False
 
 
 def create_logger(name: str = "cfsi_logger",
                   level: int = logging.INFO) -> logging.Logger:
-    """ Sets up and returns a logger. """
+    """ Sets up and returns a logger. Handlers are added only on the first call for each name """
     logger = logging.getLogger(name)
+    if name in _CONFIGURED_LOGGERS:
+        return logger
+    _CONFIGURED_LOGGERS.add(name)
     logger.setLevel(level)
-    formatter = logging.Formatter('%(asctime)s %(levelname)8s %(name)20s - %(message)s')
 
-    if not any([isinstance(handler, logging.StreamHandler) for handler in logger.handlers]):
-        stream_handler = logging.StreamHandler()
-        stream_handler.setLevel(level)
-        stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(level)
+    stream_handler.setFormatter(_FORMATTER)
+    logger.addHandler(stream_handler)
 
-    if not any([isinstance(handler, RotatingFileHandler) for handler in logger.handlers]):
-        try:
-            log_file_path = Path(os.environ["CFSI_OUTPUT_CONTAINER"]).joinpath("log", "cfsi.log")
-        except KeyError:
-            return logger
+    try:
+        log_file_path = Path(os.environ["CFSI_OUTPUT_CONTAINER"]).joinpath("log", "cfsi.log")
+    except KeyError:
+        return logger
 
+    global _log_dir_ready
+    if not _log_dir_ready:
         log_file_path.parent.mkdir(exist_ok=True)
-        file_handler = RotatingFileHandler(str(log_file_path),
-                                           maxBytes=1024 * 1024 * 2, backupCount=10)
-        file_handler.setLevel(level)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        _log_dir_ready = True
+    file_handler = RotatingFileHandler(str(log_file_path),
+                                       maxBytes=1024 * 1024 * 2, backupCount=10)
+    file_handler.setLevel(level)
+    file_handler.setFormatter(_FORMATTER)
+    logger.addHandler(file_handler)
 
     return logger
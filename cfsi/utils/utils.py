@@ -1,7 +1,12 @@
+from functools import lru_cache
+from hashlib import md5
 import os
-from typing import List
+import re
+from typing import Iterable, List, Optional, Pattern, Set
 from pathlib import Path
+from types import SimpleNamespace
 
+from datacube.index import Index
 from datacube.model import Dataset as ODCDataset
 import rasterio as rio
 from rasterio.crs import CRS
@@ -9,6 +14,28 @@ from rasterio.transform import Affine
 
 L1C_BUCKET = "sentinel-s2-l1c"
 L2A_BUCKET = "sentinel-s2-l2a"
+# GDAL options for reading rasters, .SAFE directories are not listed when opening a file
+RASTER_READ_ENV = {"GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR"}
+# Written to a mask directory after its masks have been indexed
+MASK_DONE_MARKER = ".done"
+
+
+@lru_cache(maxsize=1)
+def available_cpus() -> int:
+    """ Returns nr. of CPUs this process may run on. Unlike os.cpu_count, respects CPU affinity
+    set e.g. by taskset or container cpusets """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on all platforms
+        return os.cpu_count() or 1
+
+
+@lru_cache(maxsize=1)
+def cfsi_env() -> SimpleNamespace:
+    """ Returns CFSI output paths from environment variables, read once per process.
+    output_container: CFSI_OUTPUT_CONTAINER, output_host: CFSI_OUTPUT_HOST, None if not set """
+    return SimpleNamespace(output_container=os.environ.get("CFSI_OUTPUT_CONTAINER"),
+                           output_host=os.environ.get("CFSI_OUTPUT_HOST"))
 
 
 def get_s2_tile_ids(dataset: ODCDataset) -> (str, str):
@@ -19,13 +46,66 @@ def get_s2_tile_ids(dataset: ODCDataset) -> (str, str):
     return tile_id, s3_key
 
 
-def check_existing_mask_directory(dataset: ODCDataset, mask_product_name: str) -> bool:
-    """ Checks if a cloud mask directory for given dataset already exists """
-    # TODO: check if mask exists in index
+def check_existing_mask_directory(dataset: ODCDataset, mask_product_name: str,
+                                  mask_band_names: Iterable[str] = ("",),
+                                  done_directories: Optional[Set[Path]] = None,
+                                  index: Optional[Index] = None) -> bool:
+    """ Checks if masks for given dataset have already been written and indexed.
+    All mask files must be non-empty and the directory must contain the done marker.
+    A directory with complete mask files but no marker was either written before the marker was introduced,
+    or its masks were never indexed, e.g. the run was interrupted before indexing. It's only treated as done,
+    and the marker written to it, if its mask dataset is found in given index
+    :param mask_band_names: band names of the mask files, as passed to generate_s2_tif_path
+    :param done_directories: result of find_done_mask_directories, replaces checking the marker file, optional
+    :param index: ODC index for finding indexed masks without the marker, optional.
+     If not given, directories without the marker are never done """
     mask_output_directory = generate_s2_tif_path(dataset, mask_product_name).parent
-    if mask_output_directory.exists():
-        return True
-    return False
+    if done_directories is not None:
+        has_marker = mask_output_directory in done_directories
+    else:
+        has_marker = mask_output_directory.joinpath(MASK_DONE_MARKER).exists()
+    if has_marker:
+        return _mask_files_complete(dataset, mask_product_name, mask_band_names)
+    if index is None or not mask_output_directory.exists():  # single stat for masks not yet created
+        return False
+    if not _mask_files_complete(dataset, mask_product_name, mask_band_names):
+        return False
+    if not index.datasets.has(mask_dataset_id(mask_output_directory)):
+        return False
+    mask_output_directory.joinpath(MASK_DONE_MARKER).touch()
+    return True
+
+
+def mask_dataset_id(mask_output_directory: Path) -> str:
+    """ Returns the id of the mask dataset in given directory, generated by the mask indexers from its URI """
+    return md5(("file://" + str(mask_output_directory)).encode("utf-8")).hexdigest()
+
+
+def _mask_files_complete(dataset: ODCDataset, mask_product_name: str, mask_band_names: Iterable[str]) -> bool:
+    """ Checks that all mask files of given dataset exist and are non-empty """
+    for band_name in mask_band_names:
+        mask_file = generate_s2_tif_path(dataset, mask_product_name, band_name)
+        if not mask_file.exists() or mask_file.stat().st_size == 0:
+            return False
+    return True
+
+
+def find_done_mask_directories(mask_product_name: str) -> Set[Path]:
+    """ Finds all mask directories of given product containing the done marker with a single directory walk """
+    tiles_output_path = Path(cfsi_env().output_container).joinpath("tiles")  # S2 s3_keys start with tiles/
+    done_directories = set()
+    for root, dirs, files in os.walk(tiles_output_path):
+        if Path(root).name == mask_product_name:
+            if MASK_DONE_MARKER in files:
+                done_directories.add(Path(root))
+            dirs.clear()  # mask directories have no sub-directories to check
+    return done_directories
+
+
+def mark_mask_directory_done(mask_files: Iterable[Path]):
+    """ Writes the done marker to the directory of given mask files """
+    for mask_directory in {Path(mask_file).parent for mask_file in mask_files}:
+        mask_directory.joinpath(MASK_DONE_MARKER).touch()
 
 
 def generate_s2_tif_path(dataset: ODCDataset,
@@ -35,7 +115,7 @@ def generate_s2_tif_path(dataset: ODCDataset,
      :param dataset: ODCDataset being written
      :param product_name: product name being written. each product goes to its own sub-directory, optional
      :param band_name: name of band being written. band name is appended to filename, optional """
-    base_output_path = Path(os.environ["CFSI_OUTPUT_CONTAINER"])  # TODO: write to S3
+    base_output_path = Path(cfsi_env().output_container)  # TODO: write to S3
     tile_id, s3_key = get_s2_tile_ids(dataset)
     if band_name:
         tile_id += f"_{band_name}"
@@ -44,33 +124,40 @@ def generate_s2_tif_path(dataset: ODCDataset,
     return output_dir
 
 
+def rasterio_read_env() -> rio.Env:
+    """ Returns a rasterio environment for reading rasters. Reading multiple files in a single
+    environment, e.g. with rasterio_read_env(): ..., sets up the GDAL environment only once """
+    return rio.Env(**RASTER_READ_ENV)
+
+
 def read_transform_from_file(file_path: Path) -> (Affine, CRS):
     """ Reads and returns transformation and CRS from file """
-    with rio.open(file_path) as f:
+    with rasterio_read_env(), rio.open(file_path) as f:
         transform = f.transform
         crs = f.crs
     return transform, crs
 
 
+@lru_cache(maxsize=1)
+def _container_path_pattern(container_output_path: str) -> Pattern:
+    """ Compiles a pattern matching container output paths, with an optional file:// protocol """
+    return re.compile(f"^(file://)?{re.escape(container_output_path)}(.*)$", re.DOTALL)
+
+
 def container_path_to_global_path(*file_paths: Path) -> List[Path]:
     """ Translates container paths to global paths based on
     CFSI_OUTPUT_CONTAINER and CFSI_OUTPUT_HOST env variables.
     e.g. /output/tiles/... -> /home/ubuntu/cfsi_output/tiles/... """
+    pattern = _container_path_pattern(cfsi_env().output_container)  # TODO: more protocols
+    external_output_path = cfsi_env().output_host
     res: List[Path] = []
-    container_output_path = os.environ["CFSI_OUTPUT_CONTAINER"]
-    external_output_path = os.environ["CFSI_OUTPUT_HOST"]
     for file_path in file_paths:
-        file_string = str(file_path)
-        protocol = ""
-        if file_string.startswith("file://"):  # TODO: more protocols
-            protocol = "file://"
-            file_string = file_string[len(protocol):]
-        if file_string.startswith(container_output_path):
-            res.append(Path(protocol + file_string.replace(
-                container_output_path, external_output_path)))
+        match = pattern.match(os.fspath(file_path))
+        if match:
+            protocol, path_in_container = match.groups(default="")
+            res.append(Path(protocol + external_output_path + path_in_container))
         else:
             res.append(file_path)
-
     return res
 
 
@@ -1,19 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Tuple, Union, Dict
+from uuid import UUID
+import dask.array as da
 import numpy as np
 import xarray as xa
 import rasterio as rio
 from rasterio.crs import CRS
 from rasterio.enums import Resampling
 from rasterio.transform import Affine
+from rasterio.windows import Window
 
-from cfsi.utils import generate_s2_tif_path
+from cfsi.utils import available_cpus, generate_s2_tif_path
 from cfsi.utils.logger import create_logger
 from cfsi.utils.load_datasets import xadataset_from_odcdataset
 from datacube.model import Dataset as ODCDataset
 
 LOGGER = create_logger("write_utils")
 
+GEOTIFF_BLOCK_SIZE = 512
+# GeoTIFF compression methods supporting the PREDICTOR creation option
+PREDICTOR_COMPRESSIONS = ("lzw", "deflate", "zstd", "lzma")
+GDAL_WRITE_ENV = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "TRUE",  # don't list sibling files of written GeoTIFFs
+    "GDAL_CACHEMAX": 1024,  # MB
+    "GDAL_NUM_THREADS": "ALL_CPUS",  # compress blocks in parallel worker threads
+}
+# COG driver values of the numeric GTiff PREDICTOR creation option
+COG_PREDICTORS = {1: "NO", 2: "STANDARD", 3: "FLOATING_POINT"}
+# Chunks of L1C datasets written to GeoTIFF, multiples of GEOTIFF_BLOCK_SIZE
+L1C_WRITE_DASK_CHUNKS = {"time": 1, "y": 4 * GEOTIFF_BLOCK_SIZE, "x": 4 * GEOTIFF_BLOCK_SIZE}
+
 
 def write_l1c_dataset(dataset: ODCDataset, rgb: bool = True):
     """ Writes a ODC S2 L1C dataset to a rgb .tif file """
@@ -28,19 +46,28 @@ def write_l1c_dataset(dataset: ODCDataset, rgb: bool = True):
         return
 
     LOGGER.info(f"Writing L1C output for dataset {dataset}")
-    ds = xadataset_from_odcdataset(dataset, measurements=measurements)
-    data = [np.squeeze(ds[band].values / 10000) for band in ds.data_vars]
+    ds = xadataset_from_odcdataset(dataset, measurements=measurements, dask_chunks=L1C_WRITE_DASK_CHUNKS)
+    # lazy (band, y, x) reflectances of the single time slice
+    data = ds.to_array().data[:, 0].map_blocks(_scale_l1c_block, dtype=np.float32)
     odcdataset_to_single_tif(dataset, data, product_name=product_name)
 
 
+def _scale_l1c_block(block: np.ndarray) -> np.ndarray:
+    """ Scales a block of L1C digital numbers to float32 reflectances, dividing the float32 copy in place
+    instead of allocating another array for the result """
+    reflectances = block.astype(np.float32)
+    reflectances /= 10000
+    return reflectances
+
+
 def odcdataset_to_single_tif(dataset: ODCDataset,
-                             data: List[np.ndarray],
+                             data: Union[List[np.ndarray], np.ndarray, da.Array],
                              product_name: str = "",
                              data_type: int = rio.float32,
                              custom_transform: Tuple[Affine, CRS] = None) -> Path:
     """ Writes a list of ndarray to single .tif file.
      :param dataset: ODC dataset being written
-     :param data: list of ndarray
+     :param data: list of 2D ndarray, or a (bands, rows, cols) ndarray or dask array
      :param product_name: name of product being written, optional
      :param data_type: rasterio data type, optional
      :param custom_transform: provide custom transform and CRS, optional
@@ -59,32 +86,49 @@ def odcdataset_to_multiple_tif(dataset: ODCDataset,
                                data: Dict[str, np.ndarray],
                                product_name: str = "",
                                data_type: int = rio.float32,
-                               custom_transform: Tuple[Affine, CRS] = None) -> List[Path]:
+                               custom_transform: Tuple[Affine, CRS] = None,
+                               **creation_options) -> List[Path]:
     """ Writes output in dictionary to multiple single band .tif files.
      :param dataset: ODCDataset being written
      :param data: dict of band_name: np.ndarray, each band is written to a separate file
      :param product_name: name of product being written, optional
      :param data_type: rasterio datatype, optional
      :param custom_transform: provide custom transform and CRS, optional
+     :param creation_options: passed to array_to_geotiff, e.g. compress="deflate", optional
      :return: list of written files """
     if custom_transform:
         geo_transform, projection = custom_transform
     else:
         geo_transform, projection = rio_params_for_odcdataset(dataset)
 
-    output_paths = []
-    for band_name, band_data in data.items():
-        output_path = generate_s2_tif_path(dataset, product_name, band_name)
+    # all bands are written to the same directory, create it once instead of once per band
+    output_paths = {band_name: generate_s2_tif_path(dataset, product_name, band_name) for band_name in data}
+    for output_dir in {output_path.parent for output_path in output_paths.values()}:
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+    def write_band(band_name: str, band_data: np.ndarray) -> Path:
+        output_path = output_paths[band_name]
         array_to_geotiff(output_path, band_data,
                          geo_transform=geo_transform, projection=projection,
-                         data_type=data_type)
-        output_paths.append(output_path)
-    return output_paths
+                         data_type=data_type, make_dirs=False, **creation_options)
+        return output_path
+
+    if len(data) == 1:
+        return [write_band(*band) for band in data.items()]
+    # each band goes to its own file, GDAL releases the GIL while compressing and writing
+    with ThreadPoolExecutor(max_workers=min(len(data), available_cpus())) as executor:
+        return list(executor.map(write_band, data.keys(), data.values()))
 
 
 def rio_params_for_odcdataset(dataset: ODCDataset):
     """ Gets transformation and projection info for writing ODCDataset with rasterio """
-    ds = xadataset_from_odcdataset(dataset)
+    return _rio_params_for_odcdataset_id(dataset.id)
+
+
+@lru_cache(maxsize=256)
+def _rio_params_for_odcdataset_id(dataset_id: UUID):
+    """ Cached rio_params_for_odcdataset, ODCDatasets are not hashable so the cache is keyed by id """
+    ds = xadataset_from_odcdataset(ids=dataset_id)
     return rio_params_for_xadataset(ds)
 
 
@@ -96,37 +140,125 @@ def rio_params_for_xadataset(dataset: xa.Dataset):
 
 
 def array_to_geotiff(file_path: Path,
-                     data: Union[List[np.ndarray], np.ndarray],
+                     data: Union[List[np.ndarray], np.ndarray, da.Array],
                      geo_transform: Affine, projection: CRS,
-                     compress: str = "lzw", data_type=rio.float32):
+                     compress: str = "zstd", data_type=rio.float32,
+                     tiled: bool = True, zstd_level: int = 1, make_dirs: bool = True,
+                     cog: bool = False, **creation_options):
     """ Write a single or multi band GeoTIFF
     :param file_path: output geotiff file path including extension
-    :param data: (list of) numpy array(s), all written to single file
+    :param data: list of 2D arrays, or a single 2D or (bands, rows, cols) array, all written to single file.
+     dask arrays are computed and written one chunk at a time, chunks should be multiples of GEOTIFF_BLOCK_SIZE
     :param geo_transform: Geotransform for output raster in rasterio format
     :param projection: projection for output raster in rasterio format
     :param compress: output compression method, use "none" for uncompressed, optional
-    :param data_type: rasterio data type, optional """
-    if not file_path.parent.exists():
+    :param data_type: rasterio data type, optional
+    :param tiled: write GEOTIFF_BLOCK_SIZE tiles instead of strips, optional
+    :param zstd_level: compression level when using zstd compression, optional
+    :param make_dirs: create the output directory if it doesn't exist, optional.
+     set to False when the caller has already created it
+    :param cog: write a Cloud Optimized GeoTIFF with internal overviews built during the write,
+     no separate create_overviews pass is needed. Requires GDAL >= 3.1, see cog_driver_available, optional
+    :param creation_options: additional GDAL creation options, e.g. predictor=2, optional.
+     predictor defaults to 3 (floating point) for float data and 2 (horizontal differencing) for integers,
+     num_threads defaults to all_cpus and bigtiff to if_safer """
+    if make_dirs and not file_path.parent.exists():
         LOGGER.info(f"Creating output directory {file_path.parent}")
         file_path.parent.mkdir(parents=True, exist_ok=True)
-    if isinstance(data, np.ndarray):
-        data = [data]
+    if isinstance(data, (np.ndarray, da.Array)) and data.ndim == 2:
+        data = data[np.newaxis]
+
+    if compress.lower() in PREDICTOR_COMPRESSIONS:
+        creation_options.setdefault("predictor", 3 if np.dtype(data_type).kind == "f" else 2)
+    if compress.lower() == "zstd":
+        creation_options.setdefault("zstd_level", zstd_level)
+    creation_options.setdefault("num_threads", "all_cpus")
+    creation_options.setdefault("bigtiff", "if_safer")  # S2 tile sized float rasters can exceed 4GB
+    driver = "GTiff"
+    if cog:
+        driver = "COG"
+        creation_options = _cog_creation_options(creation_options)
+    elif tiled:
+        creation_options.update(tiled=True,
+                                blockxsize=GEOTIFF_BLOCK_SIZE,
+                                blockysize=GEOTIFF_BLOCK_SIZE)
 
     rows, cols = data[0].shape  # Create raster of given size and projection
-    with rio.open(file_path, "w",
-                  driver="GTiff", compress=compress,
-                  height=rows, width=cols,
-                  transform=geo_transform, crs=projection,
-                  count=(len(data)), nodata=0,
-                  dtype=data_type) as dest:
-
-        for idx, d in enumerate(data):
-            dest.write(d.astype(data_type), idx + 1)
-
-
-def create_overviews(file_path: Path):
-    """ Create internal overviews to GeoTIFF
-    :param file_path: Path to GeoTIFF file """
-    with rio.open(file_path, "r+") as f:
-        f.build_overviews([2, 4, 8, 16, 32], Resampling.nearest)
-        f.update_tags(ns="rio_overview", resampling="nearest")
+    with rio.Env(**GDAL_WRITE_ENV), rio.open(file_path, "w",
+                                             driver=driver, compress=compress,
+                                             height=rows, width=cols,
+                                             transform=geo_transform, crs=projection,
+                                             count=(len(data)), nodata=0,
+                                             dtype=data_type, **creation_options) as dest:
+
+        if isinstance(data, da.Array):
+            _write_dask_array(dest, data, data_type)
+            return
+
+        if not tiled or cog:  # COG is written from an in-memory copy, whole bands are written to it
+            if isinstance(data, np.ndarray):  # (bands, rows, cols) array, write all bands in one call
+                dest.write(data.astype(data_type, copy=False))
+                return
+            for idx, d in enumerate(data):
+                dest.write(d.astype(data_type, copy=False), idx + 1)  # cast only when the dtype differs
+            return
+
+        # write one tile of all bands at a time, so GDAL never caches more than a tile
+        for _, window in dest.block_windows(1):
+            block = (slice(None),) + window.toslices()
+            if isinstance(data, np.ndarray):
+                dest.write(data[block].astype(data_type, copy=False), window=window)
+            else:
+                for idx, d in enumerate(data):
+                    dest.write(d[block[1:]].astype(data_type, copy=False), idx + 1, window=window)
+
+
+def _cog_creation_options(creation_options: Dict) -> Dict:
+    """ Translates GTiff creation options to their COG driver equivalents """
+    creation_options = dict(creation_options)
+    if "predictor" in creation_options:
+        creation_options["predictor"] = COG_PREDICTORS.get(creation_options["predictor"],
+                                                           creation_options["predictor"])
+    if "zstd_level" in creation_options:
+        creation_options["level"] = creation_options.pop("zstd_level")
+    creation_options.update(blocksize=GEOTIFF_BLOCK_SIZE, overview_resampling=Resampling.nearest.name)
+    return creation_options
+
+
+@lru_cache(maxsize=1)
+def cog_driver_available() -> bool:
+    """ Returns True if GDAL has the COG driver, added in GDAL 3.1 """
+    with rio.Env() as env:
+        return "COG" in env.drivers()
+
+
+def _write_dask_array(dest: rio.io.DatasetWriter, data: da.Array, data_type):
+    """ Computes and writes a (bands, rows, cols) dask array one spatial chunk at a time.
+    The next chunk is computed in a background thread while the current one is compressed and written,
+    at most two chunks of all bands are held in memory """
+    row_offsets = np.cumsum((0,) + data.chunks[1])
+    col_offsets = np.cumsum((0,) + data.chunks[2])
+    windows = [Window(col_start, row_start, col_end - col_start, row_end - row_start)
+               for row_start, row_end in zip(row_offsets[:-1], row_offsets[1:])
+               for col_start, col_end in zip(col_offsets[:-1], col_offsets[1:])]
+
+    def compute_block(window: Window) -> np.ndarray:
+        return data[(slice(None),) + window.toslices()].compute().astype(data_type, copy=False)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_block = executor.submit(compute_block, windows[0])
+        for index, window in enumerate(windows):
+            block = next_block.result()
+            if index + 1 < len(windows):
+                next_block = executor.submit(compute_block, windows[index + 1])
+            dest.write(block, window=window)
+
+
+def create_overviews(file_path: Path, resampling: Resampling = Resampling.nearest):
+    """ Create internal overviews to GeoTIFF, overview levels are computed by parallel GDAL threads
+    :param file_path: Path to GeoTIFF file
+    :param resampling: overview resampling method, nearest keeps values of categorical bands valid, optional """
+    with rio.Env(GDAL_NUM_THREADS="ALL_CPUS", GDAL_TIFF_OVR_BLOCKSIZE=GEOTIFF_BLOCK_SIZE), \
+            rio.open(file_path, "r+") as f:
+        f.build_overviews([2, 4, 8, 16, 32], resampling)
+        f.update_tags(ns="rio_overview", resampling=resampling.name)
@@ -0,0 +1,65 @@
+import os
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+
+from cfsi.utils import (MASK_DONE_MARKER, cfsi_env, check_existing_mask_directory, generate_s2_tif_path,
+                        mask_dataset_id)
+
+MASK_PRODUCT_NAME = "s2_level1c_s2cloudless"
+MASK_BAND_NAMES = ("clouds", "shadows")
+
+
+def fake_dataset():
+    """ Stands in for a L1C ODCDataset, only the properties used for mask paths are set """
+    return SimpleNamespace(metadata_doc={"properties": {
+        "tile_id": "S2A_OPER_MSI_L1C_TL_TEST_20200101T000000_A000000_T35VLG_N02.08",
+        "s3_key": "tiles/35/V/LG/2020/1/1/0",
+    }})
+
+
+def fake_index(indexed_ids):
+    """ Stands in for an ODC Index, knows only given dataset ids """
+    return SimpleNamespace(datasets=SimpleNamespace(has=lambda id_: id_ in indexed_ids))
+
+
+def write_mask_files(dataset) -> Path:
+    """ Writes non-empty mask files for given dataset, returns the mask directory """
+    for band_name in MASK_BAND_NAMES:
+        mask_file = generate_s2_tif_path(dataset, MASK_PRODUCT_NAME, band_name)
+        mask_file.parent.mkdir(parents=True, exist_ok=True)
+        mask_file.write_bytes(b"mask")
+    return mask_file.parent
+
+
+def check(dataset, index) -> bool:
+    return check_existing_mask_directory(dataset, MASK_PRODUCT_NAME, MASK_BAND_NAMES, index=index)
+
+
+def test_unindexed_mask_directory_is_not_skipped():
+    with TemporaryDirectory() as output_path:
+        os.environ["CFSI_OUTPUT_CONTAINER"] = output_path
+        cfsi_env.cache_clear()
+        dataset = fake_dataset()
+        mask_directory = write_mask_files(dataset)
+
+        assert not check(dataset, fake_index(set()))
+        assert not check(dataset, None)
+        assert not mask_directory.joinpath(MASK_DONE_MARKER).exists()
+
+
+def test_indexed_mask_directory_without_marker_is_skipped():
+    with TemporaryDirectory() as output_path:
+        os.environ["CFSI_OUTPUT_CONTAINER"] = output_path
+        cfsi_env.cache_clear()
+        dataset = fake_dataset()
+        mask_directory = write_mask_files(dataset)
+
+        assert check(dataset, fake_index({mask_dataset_id(mask_directory)}))
+        assert mask_directory.joinpath(MASK_DONE_MARKER).exists()
+        assert check(dataset, fake_index(set()))  # the marker is enough from now on
+
+
+if __name__ == "__main__":
+    test_unindexed_mask_directory_is_not_skipped()
+    test_indexed_mask_directory_without_marker_is_skipped()
@@ -0,0 +1,39 @@
+import numpy as np
+
+from cfsi.utils.kernels import shadow_mask_kernel, shift_mask
+
+
+def reference_shift(mask: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """ Per-pixel reference for shift_mask: out[r, c] = mask[r + dy, c - dx], 0 outside the mask """
+    rows, cols = mask.shape
+    shifted = np.zeros_like(mask)
+    for r in range(rows):
+        for c in range(cols):
+            if 0 <= r + dy < rows and 0 <= c - dx < cols:
+                shifted[r, c] = mask[r + dy, c - dx]
+    return shifted
+
+
+def test_shift_mask():
+    mask = np.random.default_rng(0).integers(0, 2, size=(7, 9), dtype=np.uint8)
+    for dy in (-10, -3, -1, 0, 1, 3, 10):
+        for dx in (-12, -4, -1, 0, 1, 4, 12):
+            assert np.array_equal(shift_mask(mask, dy, dx), reference_shift(mask, dy, dx)), (dy, dx)
+
+
+def test_shadow_mask_kernel():
+    rng = np.random.default_rng(1)
+    cloud_mask_array = rng.integers(0, 2, size=(7, 9), dtype=np.uint8)
+    nir_array = rng.integers(0, 3000, size=(7, 9), dtype=np.uint16)
+    dark_pixel_threshold = 1500
+    for dy, dx in ((2, -3), (-2, 3), (0, 0)):
+        shadow_mask_array = shift_mask(cloud_mask_array, dy, dx)
+        expected = (cloud_mask_array == 0) & (shadow_mask_array == 1) & (nir_array <= dark_pixel_threshold)
+        out_arr = np.empty_like(cloud_mask_array, dtype=np.uint8)
+        shadow_mask_kernel(cloud_mask_array, shadow_mask_array, nir_array, dark_pixel_threshold, out_arr)
+        assert np.array_equal(out_arr, expected.astype(np.uint8)), (dy, dx)
+
+
+if __name__ == "__main__":
+    test_shift_mask()
+    test_shadow_mask_kernel()
@@ -0,0 +1,49 @@
+import numpy as np
+
+from cfsi.utils.kernels import mosaic_kernel, mosaic_kernel_no_recentness
+
+
+def time_slices():
+    """ Two (band, y, x) time slices of a 1x3 mosaic, newest first. In the newest slice,
+    pixel 0 has data in all bands, pixel 1 is nodata in band 0 only and pixel 2 is masked out """
+    newest = np.array([[[10, 0, 30]],
+                       [[11, 21, 31]],
+                       [[12, 22, 32]]], dtype=np.uint16)
+    valid_newest = np.array([[True, True, False]])
+    oldest = np.array([[[40, 50, 60]],
+                       [[41, 51, 61]],
+                       [[42, 52, 62]]], dtype=np.uint16)
+    valid_oldest = np.ones((1, 3), dtype=bool)
+    return (newest, valid_newest), (oldest, valid_oldest)
+
+
+def test_mosaic_kernel_first_band_decides():
+    (newest, valid_newest), (oldest, valid_oldest) = time_slices()
+    out_arr = np.zeros_like(newest)
+    recentness_arr = np.zeros((1, 3), dtype=np.uint16)
+
+    # band 0 nodata leaves the whole pixel unfilled, other bands aren't copied either
+    assert mosaic_kernel(newest, valid_newest, 2, out_arr, recentness_arr) == 2
+    assert np.array_equal(out_arr[:, 0, :], [[10, 0, 0], [11, 0, 0], [12, 0, 0]])
+    assert np.array_equal(recentness_arr, [[2, 0, 0]])
+
+    # the unfilled pixels get all bands from the same older slice
+    assert mosaic_kernel(oldest, valid_oldest, 1, out_arr, recentness_arr) == 0
+    assert np.array_equal(out_arr[:, 0, :], [[10, 50, 60], [11, 51, 61], [12, 52, 62]])
+    assert np.array_equal(recentness_arr, [[2, 1, 1]])
+
+
+def test_mosaic_kernel_no_recentness_first_band_decides():
+    (newest, valid_newest), (oldest, valid_oldest) = time_slices()
+    out_arr = np.zeros_like(newest)
+
+    assert mosaic_kernel_no_recentness(newest, valid_newest, out_arr) == 2
+    assert np.array_equal(out_arr[:, 0, :], [[10, 0, 0], [11, 0, 0], [12, 0, 0]])
+
+    assert mosaic_kernel_no_recentness(oldest, valid_oldest, out_arr) == 0
+    assert np.array_equal(out_arr[:, 0, :], [[10, 50, 60], [11, 51, 61], [12, 52, 62]])
+
+
+if __name__ == "__main__":
+    test_mosaic_kernel_first_band_decides()
+    test_mosaic_kernel_no_recentness_first_band_decides()
@@ -8,5 +8,8 @@ datacube product add cfsi/products/s2_granules.yaml
 datacube product add cfsi/products/s2cloudless_masks.yaml
 datacube product add cfsi/products/cloudless_mosaic.yaml
 
+python3 -m cfsi.test.masks.test_shadow_masks
+python3 -m cfsi.test.masks.test_existing_masks
+python3 -m cfsi.test.mosaic.test_mosaic_kernels
 python3 -m cfsi.test.index.test_mosaic_index
 python3 -m cfsi.scripts.index.s2_index